@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Benchmarks for file_stats.py.
+
+hashing
+    Writes a set of temporary files and times hashing them with each
+    of the hash algorithms, with one process and with a pool of
+    processes.
+
+matching
+    Times matching a list of synthetic filenames against the default
+    patterns with fnmatch, one pattern at a time, and with the compiled
+    PatternMatcher.
+
+For usage, see command-line help:
+    $ ./bench_file_stats.py -h
+
+"""
+
+import os
+import sys
+import time
+import random
+import fnmatch
+import shutil
+import tempfile
+from functools import partial
+
+import argparse
+
+import file_stats
+
+def make_files(dirname, nfiles, size):
+    """Write nfiles files of size bytes of random data in dirname.
+
+    Returns
+    -------
+    file_list : list
+        Filenames of the files written.
+
+    """
+
+    file_list = []
+    block = os.urandom(min(size, file_stats.hash_block_size))
+    for i in range(nfiles):
+        fn = os.path.join(dirname, 'bench%04d.nii' % i)
+        fp = open(fn, 'wb')
+        try:
+            written = 0
+            while written < size:
+                fp.write(block[:size - written])
+                written += len(block)
+        finally:
+            fp.close()
+        file_list.append(fn)
+    return file_list
+
+def time_hashing(file_list, algo, jobs):
+    """Return the seconds taken to hash all files in file_list."""
+    hash_func = partial(file_stats._hash_file, algo=algo)
+    map_func = map
+    pool = None
+    if jobs > 1:
+        pool = file_stats.Pool(jobs)
+        map_func = pool.imap
+    try:
+        t1 = time.time()
+        # file_hashes prints a dot per file, keep the output readable
+        devnull = open(os.devnull, 'w')
+        stderr = sys.stderr
+        sys.stderr = devnull
+        try:
+            file_stats.file_hashes(file_list, hash_func, map_func=map_func)
+        finally:
+            sys.stderr = stderr
+            devnull.close()
+        t2 = time.time()
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return t2 - t1
+
+def bench_hashing(file_list, jobs):
+    """Print hashing throughput of each algorithm with 1 and jobs
+    processes."""
+    nbytes = sum(os.path.getsize(fn) for fn in file_list)
+    print "== Hashing %d files, %d MB ==" % (len(file_list), nbytes >> 20)
+    print "%-10s %6s %10s %10s" % ('algo', 'jobs', 'seconds', 'MB/s')
+    for algo in sorted(file_stats.hash_algorithms):
+        for njobs in sorted(set([1, jobs])):
+            secs = time_hashing(file_list, algo, njobs)
+            print "%-10s %6d %10.3f %10.1f" % (algo, njobs, secs,
+                                               nbytes / secs / 2**20)
+
+def make_names(nnames):
+    """Return a list of nnames synthetic filenames."""
+    exts = ['.nii', '.nii.gz', '.img', '.img.gz', '.hdr', '.mat', '.txt',
+            '.dcm', '.png', '']
+    rng = random.Random(0)
+    return ['sub%05d_run%02d%s' % (rng.randint(0, 99999), rng.randint(0, 99),
+                                   rng.choice(exts))
+            for i in xrange(nnames)]
+
+def bench_matching(names, patterns='*.nii*;*.img*'):
+    """Print the time taken to match names against patterns with
+    fnmatch and with PatternMatcher."""
+    print "== Matching %d names against %s ==" % (len(names), patterns)
+    pattern_list = patterns.split(';')
+    t1 = time.time()
+    fn_count = 0
+    for name in names:
+        for pattern in pattern_list:
+            if fnmatch.fnmatch(name, pattern):
+                fn_count += 1
+                break
+    t2 = time.time()
+    matcher = file_stats.PatternMatcher(patterns)
+    match = matcher.match
+    pm_count = 0
+    for name in names:
+        if match(name):
+            pm_count += 1
+    t3 = time.time()
+    assert fn_count == pm_count
+    print "%-16s %10s %10s" % ('matcher', 'seconds', 'matches')
+    print "%-16s %10.3f %10d" % ('fnmatch', t2 - t1, fn_count)
+    print "%-16s %10.3f %10d" % ('PatternMatcher', t3 - t2, pm_count)
+    print "speed-up: %.1fx" % ((t2 - t1) / (t3 - t2))
+
+def main(argv=None):
+    desc = 'Benchmark the file_stats hashing and matching code.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('benchmarks', nargs='*',
+                        default=['hashing', 'matching'],
+                        help='benchmarks to run: hashing, matching [all]')
+    parser.add_argument('-f', '--files', type=int, default=16,
+                        help='number of files to hash [16]')
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help='size of each file in MB [64]')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of processes to compare against [4]')
+    parser.add_argument('--names', type=int, default=1000000,
+                        help='number of filenames to match [1000000]')
+    args = parser.parse_args()
+
+    if 'hashing' in args.benchmarks:
+        dirname = tempfile.mkdtemp(prefix='bench_file_stats')
+        try:
+            file_list = make_files(dirname, args.files, args.size * 2**20)
+            bench_hashing(file_list, args.jobs)
+        finally:
+            shutil.rmtree(dirname)
+
+    if 'matching' in args.benchmarks:
+        bench_matching(make_names(args.names))
+
+if __name__ == '__main__':
+    main()
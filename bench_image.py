@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Benchmarks for reading slices of gzipped images.
+
+Writes a temporary .nii.gz volume of random data and times:
+
+full
+    Decompressing the whole file, which is what reading any slice cost
+    before the gzip index.
+index
+    Building the gzip_index.GzipIndex of the file, done once on the
+    first slice read.
+axial, coronal, sagittal
+    Reading slices through image.VolumeProxy with the index built.
+    Axial slices are contiguous in the file and only decompress a few
+    MB; sagittal slices touch every plane and decompress most of it.
+
+For usage, see command-line help:
+    $ ./bench_image.py -h
+
+"""
+
+import os
+import time
+import gzip
+import struct
+import shutil
+import tempfile
+
+import argparse
+
+import numpy as np
+
+import gzip_index
+from image import VolumeProxy
+
+def write_nifti(filename, data):
+    """Write the int16 array data as a gzipped single file NIfTI-1
+    image, without needing an image library."""
+    data = np.asarray(data, '<i2')
+    hdr = bytearray(352)
+    dim = (data.ndim,) + data.shape + (1,) * (7 - data.ndim)
+    struct.pack_into('<i', hdr, 0, 348)
+    struct.pack_into('<8h', hdr, 40, *dim)
+    struct.pack_into('<2h', hdr, 70, 4, 16)
+    struct.pack_into('<8f', hdr, 76, *((1.0,) * 8))
+    struct.pack_into('<3f', hdr, 108, 352, 1, 0)
+    hdr[344:348] = 'n+1\0'
+    fp = gzip.open(filename, 'wb')
+    try:
+        fp.write(str(hdr))
+        fp.write(data.tostring(order='F'))
+    finally:
+        fp.close()
+
+def time_slices(proxy, axis, count):
+    """Return the mean seconds to read count slices along axis."""
+    size = proxy.header.shape[axis]
+    indices = np.linspace(0, size - 1, count).astype(int)
+    t1 = time.time()
+    for i in indices:
+        index = [slice(None)] * 3
+        index[axis] = i
+        proxy[tuple(index)]
+    return (time.time() - t1) / count
+
+def bench_slices(filename, spacing, count):
+    """Print the time to decompress filename and to read slices from
+    it through the gzip index."""
+    print "== %s, %d MB compressed, index every %d MB ==" % (
+        os.path.basename(filename), os.path.getsize(filename) >> 20,
+        spacing >> 20)
+    print "%-10s %10s" % ('read', 'seconds')
+    t1 = time.time()
+    fp = gzip.open(filename, 'rb')
+    try:
+        while fp.read(gzip_index.read_size * 16):
+            pass
+    finally:
+        fp.close()
+    full = time.time() - t1
+    print "%-10s %10.3f" % ('full', full)
+    t1 = time.time()
+    gzip_index.get_index(filename, spacing)
+    print "%-10s %10.3f" % ('index', time.time() - t1)
+    proxy = VolumeProxy(filename, None)
+    for axis, name in enumerate(['sagittal', 'coronal', 'axial']):
+        secs = time_slices(proxy, axis, count)
+        print "%-10s %10.3f   %.1fx faster than full" % (name, secs,
+                                                        full / secs)
+
+def main(argv=None):
+    desc = 'Benchmark reading slices of a .nii.gz image.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='size of each side of the volume [256]')
+    parser.add_argument('--spacing', type=int, default=4,
+                        help='MB between gzip index access points [4]')
+    parser.add_argument('-c', '--count', type=int, default=10,
+                        help='number of slices read per axis [10]')
+    args = parser.parse_args()
+
+    dirname = tempfile.mkdtemp(prefix='bench_image')
+    try:
+        filename = os.path.join(dirname, 'bench.nii.gz')
+        # Smooth data compresses like an image, unlike uniform noise
+        rng = np.random.RandomState(0)
+        shape = (args.size,) * 3
+        data = rng.randint(0, 64, shape).astype(np.int16)
+        data += np.arange(args.size, dtype=np.int16) * 8
+        write_nifti(filename, data)
+        bench_slices(filename, args.spacing * 2**20, args.count)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Colormap lookup tables for rendering image slices.
+
+A slice is drawn by quantizing its values between the low and high
+ends of a window into indices into a lookup table of RGBA colors, then
+taking the colors of the indices.  Colorizer keeps the indices, so a
+new colormap only needs the take, and reuses its arrays from one slice
+to the next.
+
+Only numpy is needed, so the same colormaps are used by the viewer and
+by rendering without a GUI.
+
+"""
+
+import numpy as np
+
+# Colormaps as (position, red, green, blue) control points, colors are
+# interpolated linearly between them.
+segments = {
+    'gray': [(0.0, 0.0, 0.0, 0.0), (1.0, 1.0, 1.0, 1.0)],
+    'hot': [(0.0, 0.0, 0.0, 0.0), (0.375, 1.0, 0.0, 0.0),
+            (0.75, 1.0, 1.0, 0.0), (1.0, 1.0, 1.0, 1.0)],
+    'cool': [(0.0, 0.0, 1.0, 1.0), (1.0, 1.0, 0.0, 1.0)],
+    'bone': [(0.0, 0.0, 0.0, 0.0), (0.375, 0.319, 0.319, 0.444),
+             (0.75, 0.652, 0.777, 0.777), (1.0, 1.0, 1.0, 1.0)],
+    'jet': [(0.0, 0.0, 0.0, 0.5), (0.11, 0.0, 0.0, 1.0),
+            (0.125, 0.0, 0.0, 1.0), (0.375, 0.0, 1.0, 1.0),
+            (0.64, 1.0, 1.0, 0.0), (0.91, 1.0, 0.0, 0.0),
+            (1.0, 0.5, 0.0, 0.0)],
+    }
+
+# Default number of colors in a lookup table.  Tables of more than 256
+# colors are indexed with uint16 instead of uint8.
+default_size = 256
+
+def make_lut(points, size=default_size):
+    """Return a lookup table of size colors from control points.
+
+    Parameters
+    ----------
+    points : list
+        (position, red, green, blue) tuples with positions increasing
+        from 0 to 1 and colors from 0 to 1.
+    size : int
+        Number of colors.
+
+    Returns
+    -------
+    lut : numpy.ndarray
+        Opaque RGBA colors, uint8 array of shape (size, 4).
+
+    """
+
+    points = np.asarray(points, np.float64)
+    x = np.linspace(0, 1, size)
+    lut = np.empty((size, 4), np.uint8)
+    for channel in range(3):
+        values = np.interp(x, points[:, 0], points[:, channel + 1])
+        lut[:, channel] = np.round(values * 255)
+    lut[:, 3] = 255
+    return lut
+
+def get_lut(name, size=default_size):
+    """Return the lookup table of the colormap called name."""
+    try:
+        return make_lut(segments[name], size)
+    except KeyError:
+        raise KeyError("Unable to find colormap '%s'" % name)
+
+def index_dtype(size):
+    """Return the smallest unsigned dtype that indexes size colors."""
+    if size <= 256:
+        return np.uint8
+    return np.uint16
+
+def quantize(data, low, high, size, out=None, scratch=None):
+    """Map data between low and high to indices 0 to size - 1.
+
+    Values outside the window get the index of its nearest end.
+
+    Parameters
+    ----------
+    data : array
+        Values to quantize.
+    low, high : float
+        The window.
+    size : int
+        Number of colors in the lookup table.
+    out : numpy.ndarray
+        Array of data's shape to write the indices to, a new one of
+        index_dtype(size) if None.
+    scratch : numpy.ndarray
+        float32 array of data's shape used for the arithmetic, a new
+        one if None.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        The indices.
+
+    """
+
+    if out is None:
+        out = np.empty(data.shape, index_dtype(size))
+    if scratch is None:
+        scratch = np.empty(data.shape, np.float32)
+    low = float(low)
+    high = float(high)
+    if high <= low:
+        high = low + 1
+    # Subtract as floats so integer data cannot overflow
+    np.subtract(data, low, out=scratch)
+    np.multiply(scratch, size / (high - low), out=scratch)
+    np.clip(scratch, 0, size - 1, out=scratch)
+    out[...] = scratch
+    return out
+
+class Colorizer(object):
+    """Color slices through a lookup table into reused arrays.
+
+    The indices and RGBA arrays are kept and written over for each
+    slice of the same shape, so drawing does not allocate.  The RGBA
+    array returned is the same object until the shape changes, copy it
+    to keep it.
+
+    Parameters
+    ----------
+    lut : numpy.ndarray
+        (n, 4) uint8 RGBA lookup table.
+    window : tuple
+        (low, high) values mapped to the ends of the table, or None to
+        use the range of each slice.
+
+    """
+
+    def __init__(self, lut, window=None):
+        self.lut = np.ascontiguousarray(lut, np.uint8)
+        self.window = window
+        self.data = None
+        self._indices = None
+        self._scratch = None
+        self._rgba = None
+
+    def _buffers(self, shape):
+        """Make sure the arrays are of the slice shape."""
+        if self._indices is None or self._indices.shape != shape or \
+                self._indices.dtype != index_dtype(len(self.lut)):
+            self._indices = np.empty(shape, index_dtype(len(self.lut)))
+            self._scratch = np.empty(shape, np.float32)
+            self._rgba = np.empty(shape + (4,), np.uint8)
+
+    def current_window(self):
+        """Return the (low, high) window the current slice is colored
+        with.
+
+        Without a window this is the range of the finite values of the
+        slice, or (0, 1) if it has none.
+
+        """
+
+        if self.window is not None:
+            return self.window
+        data = self.data
+        if data.dtype.kind in 'fc':
+            data = data[np.isfinite(data)]
+        if data.size == 0:
+            return 0, 1
+        return data.min(), data.max()
+
+    def quantize(self):
+        """Quantize the current slice with the current window."""
+        self._buffers(self.data.shape)
+        low, high = self.current_window()
+        quantize(self.data, low, high, len(self.lut), self._indices,
+                 self._scratch)
+
+    def colorize(self):
+        """Return the RGBA colors of the quantized slice."""
+        np.take(self.lut, self._indices, axis=0, out=self._rgba, mode='clip')
+        return self._rgba
+
+    def __call__(self, data):
+        """Return the RGBA colors of the slice data."""
+        self.data = data
+        self.quantize()
+        return self.colorize()
+
+    def set_lut(self, lut):
+        """Use another lookup table.  Returns the recolored slice, if
+        there is one."""
+        resize = len(lut) != len(self.lut)
+        self.lut = np.ascontiguousarray(lut, np.uint8)
+        if self.data is None:
+            return None
+        if resize:
+            self.quantize()
+        return self.colorize()
+
+    def set_window(self, window):
+        """Use another window, None for the range of each slice.
+        Returns the recolored slice, if there is one."""
+        self.window = window
+        if self.data is None:
+            return None
+        self.quantize()
+        return self.colorize()
@@ -0,0 +1,102 @@
+"""Persistent index of file stats and digests used by file_stats.py.
+
+The index is an SQLite database, keyed by path, which records the
+size, mtime and inode of each file along with any digests calculated
+for it.  A digest is only reused while the (size, mtime, inode) of the
+file are unchanged, so repeat runs over the same tree only read files
+that were added or modified since the last run.
+
+"""
+
+import os
+
+# sqlite3 is missing from some minimal Python builds.  The index path
+# can still be worked out without it, FileIndex cannot be used.
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+def default_index_path():
+    """Return the default location of the index database."""
+    cache_dir = os.getenv('XDG_CACHE_HOME', os.path.join('~', '.cache'))
+    cache_dir = os.path.expanduser(cache_dir)
+    return os.path.join(cache_dir, 'file_stats', 'index.sqlite')
+
+def _stat_key(st):
+    """Return the fields of the stat result st that identify a version
+    of a file."""
+    return int(st.st_size), float(st.st_mtime), int(st.st_ino)
+
+class FileIndex(object):
+    """On-disk index of file digests.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the SQLite database.  Created if it does not exist.
+    rebuild : {True, False}
+        Discard all entries in the index.
+
+    """
+
+    def __init__(self, filename=None, rebuild=False):
+        if sqlite3 is None:
+            raise ImportError('The file index requires the sqlite3 module')
+        if filename is None:
+            filename = default_index_path()
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        # Paths are byte strings which may not be valid utf-8
+        self.conn.text_factory = str
+        if rebuild:
+            self.conn.execute('DROP TABLE IF EXISTS hashes')
+            self.conn.execute('DROP TABLE IF EXISTS files')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files '
+                          '(path TEXT PRIMARY KEY, size INTEGER, '
+                          'mtime REAL, inode INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS hashes '
+                          '(path TEXT, kind TEXT, digest TEXT, '
+                          'PRIMARY KEY (path, kind))')
+
+    def _is_current(self, path, st):
+        """Return True if the entry for path matches the stat result st."""
+        row = self.conn.execute('SELECT size, mtime, inode FROM files '
+                                'WHERE path = ?', (path,)).fetchone()
+        return row is not None and tuple(row) == _stat_key(st)
+
+    def get(self, path, st, kind):
+        """Return the digest of kind stored for path, or None if there
+        is none or the file changed since it was stored."""
+        if not self._is_current(path, st):
+            return None
+        row = self.conn.execute('SELECT digest FROM hashes '
+                                'WHERE path = ? AND kind = ?',
+                                (path, kind)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set(self, path, st, kind, digest):
+        """Store the digest of kind for path, whose stat result is st."""
+        if not self._is_current(path, st):
+            # New or modified file, digests of other kinds are stale.
+            self.conn.execute('DELETE FROM hashes WHERE path = ?', (path,))
+            self.conn.execute('INSERT OR REPLACE INTO files '
+                              '(path, size, mtime, inode) VALUES (?, ?, ?, ?)',
+                              (path,) + _stat_key(st))
+        self.conn.execute('INSERT OR REPLACE INTO hashes '
+                          '(path, kind, digest) VALUES (?, ?, ?)',
+                          (path, kind, digest))
+
+    def commit(self):
+        """Save the changes made so far."""
+        self.conn.commit()
+
+    def close(self):
+        """Commit changes and close the index."""
+        self.conn.commit()
+        self.conn.close()
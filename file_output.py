@@ -0,0 +1,240 @@
+"""Machine readable output of file_stats.py results.
+
+Each writer has the same methods, called by file_stats.main in this
+order, each at most once:
+
+    stats(summary, patterns)
+    files(table, indices)
+    breakdown(kind, breakdown)
+    duplicates(groups)
+    close()
+
+JsonWriter and CsvWriter write each record as soon as it is produced,
+so long listings are never built up as one string.  NpzWriter saves the
+columns of the file table as numpy arrays, which np.load hands back
+without any parsing.
+
+"""
+
+import sys
+import csv
+
+# json is in the standard library for Python 2.6 and later.
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import numpy as np
+
+# Statistics in the summary dict, in output order.  The image header
+# statistics are only there if headers were read.
+stat_names = ['count', 'total', 'mean', 'min', 'max', 'std', 'var',
+              'unique_count', 'unique_total', 'allocated',
+              'headers', 'voxels', 'volumes', 'data_size',
+              'compression_ratio']
+
+# Encoding of filenames on this system, used to turn them into the
+# unicode JSON needs
+filename_encoding = sys.getfilesystemencoding() or 'utf-8'
+
+def _text(name):
+    """Return the filename name as unicode.  Bytes that are not in the
+    filename encoding are replaced, so any name can be written."""
+    if isinstance(name, str):
+        return name.decode(filename_encoding, 'replace')
+    return name
+
+def _stat_names(summary):
+    """Return the names in stat_names that are in summary."""
+    return [name for name in stat_names if name in summary]
+
+class JsonWriter(object):
+    """Write results as a single JSON object.
+
+    The object has the keys 'patterns', 'stats', 'files', 'by_dir',
+    'by_pattern', 'by_datatype' and 'duplicates', for the parts that
+    were written.
+
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self._sep = '{\n'
+
+    def _key(self, key):
+        self.fp.write('%s%s: ' % (self._sep, json.dumps(key)))
+        self._sep = ',\n'
+
+    def _list(self, items):
+        """Write items as a JSON list, one item at a time."""
+        sep = '['
+        for item in items:
+            self.fp.write(sep + '\n  ' + json.dumps(item))
+            sep = ','
+        if sep == '[':
+            self.fp.write('[]')
+        else:
+            self.fp.write('\n]')
+
+    def stats(self, summary, patterns):
+        self._key('patterns')
+        self.fp.write(json.dumps(patterns.split(';')))
+        self._key('stats')
+        self.fp.write(json.dumps(dict((name, summary[name])
+                                      for name in _stat_names(summary))))
+
+    def _file(self, table, i):
+        item = {'size': int(table.size[i]),
+                'filename': _text(table.filename(i))}
+        if 'datatype' in table.extra:
+            ndim = table.extra['ndim'][i]
+            item['shape'] = [int(n) for n in table.extra['shape'][i, :ndim]]
+            item['datatype'] = int(table.extra['datatype'][i])
+        return item
+
+    def files(self, table, indices):
+        self._key('files')
+        self._list(self._file(table, i) for i in indices)
+
+    def breakdown(self, kind, breakdown):
+        self._key('by_' + kind)
+        self._list({'total': total, 'count': count, 'name': _text(name)}
+                   for total, count, name in breakdown)
+
+    def duplicates(self, groups):
+        self._key('duplicates')
+        self._list({'digest': digest, 'files': [_text(fn) for fn in files]}
+                   for files, digest in groups)
+
+    def close(self):
+        if self._sep == '{\n':
+            self.fp.write('{')
+        self.fp.write('\n}\n')
+
+class CsvWriter(object):
+    """Write results as CSV.
+
+    Every row has the columns record, name, value, count, digest.  The
+    record column says what the row holds:
+
+    stat
+        name of the statistic and its value
+    file
+        filename and its size
+    dir, pattern, datatype
+        directory, pattern or image datatype, total size and number of
+        files
+    duplicate
+        filename, its size, the number of the group of identical
+        files it is in and the digest of the group
+
+    """
+
+    def __init__(self, fp):
+        self.writer = csv.writer(fp)
+        self.writer.writerow(['record', 'name', 'value', 'count', 'digest'])
+
+    def stats(self, summary, patterns):
+        for name in _stat_names(summary):
+            self.writer.writerow(['stat', name, summary[name], '', ''])
+
+    def files(self, table, indices):
+        sizes = table.size
+        for i in indices:
+            self.writer.writerow(['file', table.filename(i), sizes[i], '', ''])
+
+    def breakdown(self, kind, breakdown):
+        for total, count, name in breakdown:
+            self.writer.writerow([kind, name, total, count, ''])
+
+    def duplicates(self, groups):
+        for group, (files, digest) in enumerate(groups):
+            for fn in files:
+                self.writer.writerow(['duplicate', fn, '', group, digest])
+
+    def close(self):
+        pass
+
+def _blob(strings):
+    """Return strings as one uint8 array and an array of offsets.
+
+    String i is blob[offsets[i]:offsets[i+1]].tostring().
+
+    """
+
+    lengths = np.array([len(s) for s in strings], np.int64)
+    offsets = np.zeros(len(strings) + 1, np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    blob = np.frombuffer(''.join(strings), np.uint8)
+    return blob, offsets
+
+class NpzWriter(object):
+    """Write results as numpy arrays in a .npz file.
+
+    Arrays written, if the results are available:
+
+    stat_names, stat_values
+        Names and values of the statistics.
+    dirs, dir_offsets, dir_id, names, name_offsets, size, mtime, dev,
+    inode, blocks
+        The file table, see file_table.FileTable.arrays.  Strings are
+        stored as uint8 blobs indexed by an offset array.
+    col_*
+        Extra file table columns, such as the image header columns.
+    selected
+        Indices into the file table of the files listed with -n.
+    by_dir_*, by_pattern_*, by_datatype_*
+        Breakdown totals, counts, and names as blob and offsets.
+    dup_digests, dup_names, dup_name_offsets, dup_group_offsets
+        Files in group i are dup_group_offsets[i]:dup_group_offsets[i+1]
+        of the names in the dup_names blob.
+
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.arrays = {}
+
+    def stats(self, summary, patterns):
+        names = _stat_names(summary)
+        self.arrays['stat_names'] = np.array(names)
+        self.arrays['stat_values'] = np.array([summary[name]
+                                               for name in names],
+                                              np.float64)
+        self.arrays['patterns'] = np.array(patterns.split(';'))
+
+    def files(self, table, indices):
+        for name, arr in table.arrays().iteritems():
+            self.arrays[name] = arr
+        self.arrays['selected'] = np.asarray(indices, np.int64)
+
+    def breakdown(self, kind, breakdown):
+        prefix = 'by_%s_' % kind
+        self.arrays[prefix + 'totals'] = np.array([row[0] for row in breakdown],
+                                                  np.int64)
+        self.arrays[prefix + 'counts'] = np.array([row[1] for row in breakdown],
+                                                  np.int64)
+        blob, offsets = _blob([row[2] for row in breakdown])
+        self.arrays[prefix + 'names'] = blob
+        self.arrays[prefix + 'name_offsets'] = offsets
+
+    def duplicates(self, groups):
+        filenames = []
+        group_offsets = [0]
+        digests = []
+        for files, digest in groups:
+            filenames.extend(files)
+            group_offsets.append(len(filenames))
+            digests.append(digest)
+        blob, offsets = _blob(filenames)
+        self.arrays['dup_digests'] = np.array(digests, 'S')
+        self.arrays['dup_names'] = blob
+        self.arrays['dup_name_offsets'] = offsets
+        self.arrays['dup_group_offsets'] = np.array(group_offsets, np.int64)
+
+    def close(self):
+        np.savez(self.fp, **self.arrays)
+
+# Writers selectable with --format
+writers = {'json': JsonWriter, 'csv': CsvWriter, 'npz': NpzWriter}
@@ -10,7 +10,18 @@ For usage, see command-line help:
 
 Requires
 --------
-Python 2.4 or greater
+Python 2.5 or greater
+
+numpy
+
+multiprocessing, in Python 2.6 or greater
+    Optional, used to scan directories, read headers and hash files in
+    parallel with -j, --header-jobs and --hash-jobs.
+
+json, in Python 2.6 or greater, or simplejson
+
+sqlite3
+    Only needed for --index.  Missing from some minimal builds.
 
 argparse.py 
     This can be installed via yum:  yum search python-argparse
@@ -34,31 +45,73 @@ Find stats on all Nifti files only:
 OR:
     ./file_stats.py ~/data -p *.nii
 
+Find stats on all Nifti files, except the gzipped ones:
+    ./file_stats.py ~/data -p *.nii* -x *.gz
+
 Find stats on all files with 'foo' in their name:
     ./file_stats.py -p *foo* ~/data
 
 Find stats and print 3 largest files matching the pattern:
     ./file_stats.py -n 3 ~/data/nifti-nih
 
-Find duplicate files with extension .nii.gz (SLOW):
+Find stats and the 10 largest files of a huge archive in constant
+memory, printing progress every minute:
+    ./file_stats.py --stream --progress 60 -n 10 /archive
+
+Find the total size of each subject directory, two levels below
+~/data, and of the Nifti and Analyze files:
+    ./file_stats.py --by-dir 2 --by-pattern ~/data
+
+Write the statistics and a listing of all files as JSON, for other
+programs to read:
+    ./file_stats.py --format json -n -o stats.json ~/data
+
+Find the number of voxels and volumes in all images, reading only
+their headers with 8 threads:
+    ./file_stats.py --headers --header-jobs 8 ~/data
+
+Find duplicate files with extension .nii.gz.  Only files that share
+their size with another file are read:
     ./file_stats.py -p *.nii.gz --md5 ~/data
 
+Find duplicate files with 4 processes, using the cheap crc32 to pick
+candidates and sha1 to compare them:
+    ./file_stats.py --md5 --hash-jobs 4 --partial-algo crc32 \\
+        --hash-algo sha1 ~/data
+
+Find duplicate files every night, only hashing files that changed
+since the previous night:
+    ./file_stats.py --md5 --index ~/data
+
 Run file_stats on multiple directories:
     ./file_stats.py -p *.nii.gz ~/data/pype-tut ~/data/nipype-tutorial
 
 Skip selected directories with the -d or --skip-dirs option:
     ./file_stats.py ~/data -d ~/data/pype-tut/fb1-raw-study/mgh-101*
 
+Skip the 'scratch' directory in each directory one level below
+~/data, but not deeper ones.  Quote the path so the shell does not
+expand the wildcard:
+    ./file_stats.py ~/data -d '~/data/*/scratch'
+
 Support for wildcards.  Search all directories in ~/data/pype-tut:
     ./file_stats.py ~/data/pype-tut/*
 
+Scan a large (or network mounted) tree with 8 threads listing
+directories in parallel:
+    ./file_stats.py -j 8 ~/data
+
 """
 
 import os
 import sys
+import re
 import fnmatch
 import locale
 import shlex
+import time
+import heapq
+from itertools import izip, imap
 
 # the md5 module is deprecated in Python 2.6, but hashlib is only
 # available as and external package for versions of python before 2.6.
@@ -67,20 +120,119 @@ try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+# blake2b is in hashlib for Python 3.6 and later, and available for
+# older versions from the pyblake2 package.
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+import zlib
+
+# os.scandir is only in the standard library for Python 3.5 and later.
+# For older versions use the scandir package if it is installed,
+# otherwise scan_dirs falls back to all_dirs.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# multiprocessing is only available for Python 2.6 and later.  Without
+# it directories are scanned and files are hashed serially.
+try:
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    Pool = ThreadPool = None
+
+from functools import partial
 
 import numpy as np
 
 import argparse
 
+from file_table import FileTable, stat_blocks
+# FileIndex is imported with --index, as sqlite3 may be missing
+from file_index import default_index_path
+from file_output import writers
+from nifti_header import read_header, HeaderError, datatypes
+
 # XXX These are currently unused.  Consider deletion.
 nifti_pattern = '*.nii*'
 analyze_pattern = '*.img*'
 zip_pattern = '*.gz;*.zip;*.bz2'
 
-def _hash_file(filename):
+class _Crc32(object):
+    """hashlib style interface to zlib.crc32.
+
+    Much cheaper to calculate than md5, but too weak to decide two
+    files are identical.  Useful as the partial hash algorithm.
+
+    """
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return '%08x' % (self.crc & 0xffffffff)
+
+# Hash algorithms which can be selected with --partial-algo
+hash_algorithms = {'md5': md5, 'sha1': sha1, 'crc32': _Crc32}
+if blake2b is not None:
+    hash_algorithms['blake2b'] = blake2b
+# Those strong enough to decide files are identical, which can be
+# selected with --hash-algo.  crc32 only narrows down candidates.
+digest_algorithms = sorted(name for name in hash_algorithms
+                           if name != 'crc32')
+
+# Files are read and hashed in blocks of this many bytes, so memory use
+# does not depend on the file size.
+hash_block_size = 1024 * 1024
+# Number of bytes hashed from the start and the end of a file when
+# looking for candidate duplicates.
+partial_hash_size = 4 * 1024 * 1024
+
+def _update_hash(hashobj, fp, length=None):
+    """Update hashobj with length bytes read from fp in blocks.
+
+    If length is None, read to the end of the file.
+
+    """
+
+    while length is None or length > 0:
+        if length is None:
+            nbytes = hash_block_size
+        else:
+            nbytes = min(hash_block_size, length)
+            length -= nbytes
+        block = fp.read(nbytes)
+        if not block:
+            break
+        hashobj.update(block)
+
+def _hash_file(filename, algo='md5'):
     """Calculate hexdigest of the contents of filename.
 
-    Hashes the file contents, not the filename.  Uses md5 hash.
+    Hashes the file contents, not the filename.
+
+    Parameters
+    ----------
+    filename : string
+        File to hash
+    algo : string
+        Name of the hash algorithm, a key of hash_algorithms
 
     Returns
     -------
@@ -88,84 +240,477 @@ def _hash_file(filename):
 
     """
 
-    md5obj = md5()
-    fp = file(filename, 'rb')
-    md5obj.update(fp.read())
-    fp.close()
-    return md5obj.hexdigest()
+    hashobj = hash_algorithms[algo]()
+    fp = open(filename, 'rb')
+    try:
+        _update_hash(hashobj, fp)
+    finally:
+        fp.close()
+    return hashobj.hexdigest()
+
+def _hash_file_ends(filename, algo='md5'):
+    """Calculate hexdigest of the first and last partial_hash_size
+    bytes of filename.
+
+    If the file is no larger than 2 * partial_hash_size, the whole file
+    is hashed and the result is the same as _hash_file.
+
+    Returns
+    -------
+    hexdigest : string
 
-def file_hashes(file_list):
+    """
+
+    hashobj = hash_algorithms[algo]()
+    fp = open(filename, 'rb')
+    try:
+        size = os.fstat(fp.fileno()).st_size
+        if size <= 2 * partial_hash_size:
+            _update_hash(hashobj, fp)
+        else:
+            _update_hash(hashobj, fp, partial_hash_size)
+            fp.seek(size - partial_hash_size)
+            _update_hash(hashobj, fp, partial_hash_size)
+    finally:
+        fp.close()
+    return hashobj.hexdigest()
+
+# Digests stored in the index between commits, so an interrupted run
+# keeps the files it hashed
+index_commit_interval = 100
+
+def file_hashes(file_list, hash_func=_hash_file, index=None, kind='md5',
+                map_func=imap):
     """Calculate md5 hashes for all files in file_list.
 
     This can be slow, depending on size of the list.
+
+    Parameters
+    ----------
+    file_list : list
+        Filenames to hash
+    hash_func : callable
+        Called with a filename, returns the hexdigest of the file.
+    index : FileIndex or None
+        If given, digests of files that did not change since the
+        index was last updated are taken from the index instead of
+        calling hash_func.
+    kind : string
+        Name of the digest in the index.
+    map_func : callable
+        Used as map_func(hash_func, filenames) to hash the files, for
+        example the imap method of a multiprocessing.Pool.  Must
+        return the digests in the order of filenames, and should
+        return them as they are calculated so progress is shown and
+        digests are stored in the index file by file.
  
     Returns
     -------
     hashed_files : dict
         Dictionary where the keys are the md5 hashes and the values
-        are a list of all filenames that match that md5 hash.
+        are a list of all filenames that match that md5 hash, in the
+        order of file_list.
 
     """
 
+    hashes = [None] * len(file_list)
+    stats = [None] * len(file_list)
+    todo = []
+    for i, fn in enumerate(file_list):
+        if index is not None:
+            stats[i] = os.stat(fn)
+            hashes[i] = index.get(fn, stats[i], kind)
+        if hashes[i] is None:
+            todo.append(i)
+    digests = map_func(hash_func, [file_list[i] for i in todo])
+    for n, (i, hsh) in enumerate(izip(todo, digests)):
+        # Progress goes to stderr so it does not mix with the results
+        sys.stderr.write('.')
+        sys.stderr.flush()
+        hashes[i] = hsh
+        if index is not None:
+            index.set(file_list[i], stats[i], kind, hsh)
+            if (n + 1) % index_commit_interval == 0:
+                index.commit()
+
     dct = {}
-    for fn in file_list:
-        sys.stdout.write('.')
-        sys.stdout.flush()
-        hsh = _hash_file(fn)
+    for fn, hsh in zip(file_list, hashes):
         if hsh in dct:
             dct[hsh].append(fn)
         else:
             dct[hsh] = [fn]
     return dct
 
+def _size_groups(table, mask=None):
+    """Yield (size, filenames) for each size shared by more than one
+    file in table, smallest size first.
+
+    If mask is given, only files where mask is True are grouped.
+
+    """
+
+    order = table.argsort('size')
+    if mask is not None:
+        order = order[mask[order]]
+    # Sorted by size, files of the same size are next to each other
+    sizes = table.size[order]
+    bounds = np.flatnonzero(np.diff(sizes)) + 1
+    starts = np.concatenate(([0], bounds))
+    stops = np.concatenate((bounds, [len(sizes)]))
+    for start, stop in zip(starts, stops):
+        if stop - start > 1:
+            yield int(sizes[start]), list(table.filenames(order[start:stop]))
+
+def duplicate_hashes(table, index=None, algo='md5', partial_algo=None,
+                     jobs=1):
+    """Calculate hashes for the files in table that may have a
+    duplicate.
+
+    Much faster than file_hashes on all files as only files that can
+    be duplicates are read, in three stages after hard links are taken
+    out:
+
+    0. Files with the same device and inode (hard links and bind
+       mounts) are the same file.  Only the first of them is hashed,
+       and they are reported as duplicates even if no other file has
+       the same contents.
+    1. Files are grouped by size.  A file with a unique size has no
+       duplicate and is never read.
+    2. Files of the same size are hashed on their first and last
+       partial_hash_size bytes.
+    3. Files that still share a partial hash are hashed completely.
+       Small files were already hashed completely in stage 2, unless
+       partial_algo differs from algo.
+
+    Parameters
+    ----------
+    table : FileTable
+        Files and sizes returned from file_sizes
+    index : FileIndex or None
+        If given, digests of files that did not change since the
+        index was last updated are taken from the index instead of
+        reading the file.
+    algo : string
+        Hash algorithm of the full file hashes, one of
+        digest_algorithms
+    partial_algo : string or None
+        Hash algorithm of the partial hashes, a key of
+        hash_algorithms.  Defaults to algo.
+    jobs : int
+        Number of processes hashing files.
+
+    Returns
+    -------
+    hashed_files : dict
+        Dictionary where the keys are the hashes and the values
+        are a list of all filenames that match that hash.  Files
+        that are known to be unique after stage 1 or 2 are left out.
+        Links to a file that was not hashed are under the key
+        'inode DEV:INODE'.
+
+    """
+
+    if algo not in digest_algorithms:
+        raise ValueError('%s is too weak to find identical files, use '
+                         'one of %s' % (algo, ', '.join(digest_algorithms)))
+    if partial_algo is None:
+        partial_algo = algo
+    pool = None
+    map_func = imap
+    if jobs > 1 and Pool is not None:
+        pool = Pool(jobs)
+        map_func = pool.imap
+    try:
+        # Stage 0, other names of the same file
+        first, inode_groups = table.inode_groups()
+        links = {}
+        for group in inode_groups:
+            names = list(table.filenames(group))
+            links[names[0]] = names[1:]
+
+        # Stage 1, all files that share their size with another file
+        sizes = {}
+        candidates = []
+        for size, group in _size_groups(table, first):
+            for fn in group:
+                sizes[fn] = size
+            candidates.extend(group)
+
+        # Stage 2, hash the candidates all at once so the pool is kept
+        # busy, then split the groups on size again.
+        partial_kind = '%s-ends-%d' % (partial_algo, partial_hash_size)
+        partial_hashes = file_hashes(candidates,
+                                     partial(_hash_file_ends,
+                                             algo=partial_algo),
+                                     index, partial_kind, map_func)
+        dct = {}
+        collisions = []
+        for hsh, files in partial_hashes.iteritems():
+            by_size = {}
+            for fn in files:
+                by_size.setdefault(sizes[fn], []).append(fn)
+            for size, same in by_size.iteritems():
+                if len(same) < 2:
+                    continue
+                if size <= 2 * partial_hash_size and partial_algo == algo:
+                    # The partial hash is the hash of the whole file
+                    dct[hsh] = same
+                else:
+                    collisions.extend(same)
+
+        # Stage 3
+        dct.update(file_hashes(collisions, partial(_hash_file, algo=algo),
+                               index, algo, map_func))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    # Add the links back to the groups of the files they point to
+    for files in dct.itervalues():
+        for fn in files[:]:
+            files.extend(links.pop(fn, []))
+    for group in inode_groups:
+        fn = table.filename(group[0])
+        if fn in links:
+            key = 'inode %d:%d' % (table.dev[group[0]], table.inode[group[0]])
+            dct[key] = [fn] + links[fn]
+    return dct
+
+def duplicate_groups(hash_dict):
+    """Return the groups of identical files in hash_dict.
+
+    hash_dict is returned from the file_hashes or duplicate_hashes
+    function.
+
+    Returns
+    -------
+    groups : list
+        (filenames, digest) tuples for each digest shared by more than
+        one file, in order of their first filename.
+
+    """
+
+    groups = [(value, key) for key, value in hash_dict.iteritems()
+              if len(value) > 1]
+    groups.sort()
+    return groups
+
 def find_duplicate_files(hash_dict):
     """Print out any duplicate files from the hashed dictionary, hash_dict.
     
-    hash_dict is returned from file_hashes function.
+    hash_dict is returned from the file_hashes or duplicate_hashes
+    function.  Groups are printed in order of their first filename.
 
     """
 
     print '\n'
-    for key, value in hash_dict.iteritems():
-        if len(value) > 1:
-            print '\nThese files are identical (%s):' % key
-            for item in value:
-                print '\t%s' % item
+    for value, key in duplicate_groups(hash_dict):
+        print '\nThese files are identical (%s):' % key
+        for item in value:
+            print '\t%s' % item
 
 
-def file_sizes(file_list):
+def file_sizes(file_list, stat_list=None):
     """Get the file size for each file in the list.
+
+    If stat_list is given it holds a stat result for each file in
+    file_list (as yielded by scan_dirs) and the files are not stat'ed
+    again.
     
     Returns
     -------
-    size_array : numpy.recaray
-        Fields of the recarray are 'size', 'filename'.
-        To access size of first file:  size_array['size'][0]
-        To access all sizes:  size_array['size']
+    table : FileTable
+        To access size of first file:  table.size[0]
+        To access all sizes:  table.size
+        Indices of the files from smallest to largest:  table.argsort('size')
     
     """
-    lst = []
-    for fn in file_list:
-        sz = int(os.path.getsize(fn))
-        lst.append((sz, fn))
-    # sort smallest to largest (in-place)
-    lst.sort()
-    # Create an array so we can easily access the columns later
-    tmp_array = np.array(lst)
-    fn_dtype = tmp_array.dtype
-    # Create a record array so we can access the array columns via field names.
-    size_array = np.recarray((len(lst),), dtype = [('size', 'int32'), 
-                                                   ('filename', fn_dtype)])
-    size_array['size'][:] = tmp_array[:, 0]
-    size_array['filename'][:] = tmp_array[:, 1]
-    # If these fail, then something went wrong
-    assert size_array['size'].max() == size_array['size'][-1]
-    assert size_array['size'].min() == size_array['size'][0]
-    return size_array
+    table = FileTable()
+    for i, fn in enumerate(file_list):
+        if stat_list is None:
+            st = os.stat(fn)
+        else:
+            st = stat_list[i]
+        table.append(fn, st)
+    return table
+
 
+def _is_literal(text):
+    """Return True if text has no fnmatch wildcards."""
+    return not ('*' in text or '?' in text or '[' in text)
+
+def _compile_patterns(patterns):
+    """Compile a list of fnmatch patterns into one function.
+
+    Patterns of the form '*text', 'text*' and '*text*', where text has
+    no wildcards, are checked with str.endswith, str.startswith and the
+    in operator.  All other patterns are combined into one regular
+    expression.
+
+    Returns
+    -------
+    match : callable
+        Called with a filename, returns True if it matches any of the
+        patterns.
+
+    """
+
+    suffixes = []
+    prefixes = []
+    substrings = []
+    others = []
+    for pat in patterns:
+        if len(pat) > 1 and pat[0] == pat[-1] == '*' and \
+                _is_literal(pat[1:-1]):
+            substrings.append(pat[1:-1])
+        elif pat.startswith('*') and _is_literal(pat[1:]):
+            suffixes.append(pat[1:])
+        elif pat.endswith('*') and _is_literal(pat[:-1]):
+            prefixes.append(pat[:-1])
+        else:
+            others.append(pat)
+    suffixes = tuple(suffixes)
+    prefixes = tuple(prefixes)
+    regex = None
+    if others:
+        regex = re.compile('|'.join(['(?:%s)' % fnmatch.translate(pat)
+                                     for pat in others]))
+
+    def match(name):
+        if name.endswith(suffixes) or name.startswith(prefixes):
+            return True
+        for text in substrings:
+            if text in name:
+                return True
+        return regex is not None and regex.match(name) is not None
+    return match
+
+def _compile_component(pattern):
+    """Return a function matching one path component against the
+    fnmatch pattern, with the case rules of fnmatch.fnmatch."""
+    pattern = os.path.normcase(pattern)
+    if _is_literal(pattern):
+        return lambda name: os.path.normcase(name) == pattern
+    match = re.compile(fnmatch.translate(pattern)).match
+    return lambda name: match(os.path.normcase(name)) is not None
+
+class PatternMatcher(object):
+    """Match filenames against semicolon separated fnmatch patterns.
+
+    Gives the same results as calling fnmatch.fnmatch with each
+    pattern, but the patterns are compiled once (see _compile_patterns)
+    so matching a name is a few string method calls.
+
+    Parameters
+    ----------
+    patterns : string
+        Patterns to match, multiple patterns are separated by semicolon.
+    exclude : string
+        Patterns of names not to match, even if they match patterns.
+
+    """
+
+    # fnmatch.fnmatch normalizes the case of names and patterns on
+    # platforms with case insensitive filenames.
+    _normcase = os.path.normcase('A') != 'A'
+
+    def __init__(self, patterns='*', exclude=''):
+        if self._normcase:
+            patterns = os.path.normcase(patterns)
+            exclude = os.path.normcase(exclude)
+        self.patterns = patterns.split(';')
+        self._include = _compile_patterns(self.patterns)
+        self._exclude = None
+        if exclude:
+            self._exclude = _compile_patterns(exclude.split(';'))
+
+    def match(self, name):
+        """Return True if name matches the patterns and is not excluded."""
+        if self._normcase:
+            name = os.path.normcase(name)
+        if not self._include(name):
+            return False
+        return self._exclude is None or not self._exclude(name)
+
+    def pattern_index(self, name):
+        """Return the index of the first pattern name matches, or -1."""
+        if self._normcase:
+            name = os.path.normcase(name)
+        for i, pattern in enumerate(self.patterns):
+            if fnmatch.fnmatchcase(name, pattern):
+                return i
+        return -1
+
+class SkipDirs(object):
+    """Directories not to search.
+
+    Directories are compared on their whole path, so skipping
+    /data/mgh-101 does not skip /data/mgh-1010.  Plain paths are kept
+    in a set, so checking a directory takes the same time however many
+    directories are skipped.  Paths with fnmatch wildcards, like
+    /data/*/scratch, are matched one path component at a time, so a
+    wildcard never matches a '/': /data/*/scratch skips /data/a/scratch
+    but not /data/a/b/scratch.
+
+    Parameters
+    ----------
+    skip_dirs : list
+        Absolute paths of the directories to skip.
+
+    """
+
+    def __init__(self, skip_dirs=()):
+        if isinstance(skip_dirs, basestring):
+            skip_dirs = [skip_dirs]
+        self.paths = set()
+        # Wildcard paths by their number of components, each a list of
+        # compiled components
+        self._globs = {}
+        for sd in skip_dirs:
+            if not sd:
+                continue
+            sd = os.path.normpath(sd)
+            if _is_literal(sd):
+                self.paths.add(sd)
+            else:
+                parts = sd.split(os.sep)
+                self._globs.setdefault(len(parts), []).append(
+                    [_compile_component(part) for part in parts])
+
+    def __contains__(self, path):
+        if path in self.paths:
+            return True
+        if not self._globs:
+            return False
+        parts = path.split(os.sep)
+        for glob in self._globs.get(len(parts), ()):
+            for match, part in zip(glob, parts):
+                if not match(part):
+                    break
+            else:
+                return True
+        return False
+
+    def prune(self, path, subdirs):
+        """Return the subdirs of path that are not skipped."""
+        if not self.paths and not self._globs:
+            return subdirs
+        return [sdir for sdir in subdirs
+                if os.path.join(path, sdir) not in self]
+
+    def skips_tree(self, path):
+        """Return True if path, or a directory above it, is skipped."""
+        path = os.path.normpath(path)
+        while True:
+            if path in self:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
 
 def all_dirs(root, patterns='*', skip_dirs='', single_level=False, 
-             yield_folders=False):
+             yield_folders=False, exclude=''):
     """Return path of filenames that match given patterns.
     
     Parameters
@@ -175,49 +720,144 @@ def all_dirs(root, patterns='*', skip_dirs='', single_level=False,
     patterns : string
         Patterns to search for, multiple patterns are separated by semicolon.
         TODO:  Make this a list?
-    skip_dirs : string
+    skip_dirs : SkipDirs or list
         Directories to skip/ignore
     single_level : {True, False}
         TODO: Change to recurse and reverse logic below!
     yield_folders : {True, False}
         TODO: Understand this param.
+    exclude : string
+        Patterns of files to leave out, separated by semicolon.
 
     Notes
     -----
     Code taken from Python Cookbook Recipe 2.16
 
     """
-    patterns = patterns.split(';')
+    matcher = PatternMatcher(patterns, exclude)
+    if not isinstance(skip_dirs, SkipDirs):
+        skip_dirs = SkipDirs(skip_dirs)
+    if skip_dirs.skips_tree(root):
+        return
     for path, subdirs, files in os.walk(root):
-        # Handle skip_dirs.  skip_dirs is a list (or set) of directories to
-        # skip.  Each directory in the list should be an absolute
-        # path.  For each directory in the skip_dirs, if it matches a
-        # directory returned in subdirs (which are subdirectories to
-        # be searched next by os.walk), then remove them from the list
-        # so they are not searched again.
-        to_remove = []
-        for sd in skip_dirs:
-            for sdir in subdirs:
-                if sd in os.path.join(path, sdir):
-                    to_remove.append(sdir)
-        # Remove the subdirs outside of the above for-loop because
-        # there we are iterating over the subdirs and it is not safe
-        # to modify a sequence you are iterating over!
-        for sdir in to_remove:
-            subdirs.remove(sdir)
+        # Remove skipped directories in place so os.walk does not
+        # search them.
+        subdirs[:] = skip_dirs.prune(path, subdirs)
         if yield_folders:
             files.extend(subdirs)
         files.sort()
         for name in files:
             # We don't care about symlinks.  Ignore any we find.
-            if not os.path.islink(os.path.join(path, name)):
-                for pattern in patterns:
-                    if fnmatch.fnmatch(name, pattern):
-                        yield os.path.join(path, name)
-                        break
+            if matcher.match(name) and \
+                    not os.path.islink(os.path.join(path, name)):
+                yield os.path.join(path, name)
         if single_level:
             break
 
+def _list_dir(path, matcher):
+    """List the directory path using scandir.
+
+    Only files that matcher, a PatternMatcher, matches are stat'ed.  Symlinks
+    are ignored, as in all_dirs.
+
+    Returns
+    -------
+    files : list
+        Sorted list of (name, stat) tuples for the matching files.
+    subdirs : list
+        Sorted list of subdirectory names.
+
+    """
+
+    files = []
+    subdirs = []
+    try:
+        entries = scandir(path)
+    except OSError:
+        # os.walk silently skips directories it cannot list, do the same.
+        return files, subdirs
+    for entry in entries:
+        try:
+            # We don't care about symlinks.  Ignore any we find.
+            if entry.is_symlink():
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.name)
+                continue
+            if matcher.match(entry.name):
+                files.append((entry.name, entry.stat()))
+        except OSError:
+            # File removed while we were scanning
+            continue
+    # Names in a directory are unique so this sorts on the name only.
+    files.sort()
+    subdirs.sort()
+    return files, subdirs
+
+def scan_dirs(root, patterns='*', skip_dirs='', jobs=1, exclude=''):
+    """Yield (filename, stat) for files that match given patterns.
+
+    Like all_dirs, but uses scandir so each matching file is stat'ed
+    once and the stat result is handed back to the caller instead of
+    being thrown away.  Subdirectories are listed by a pool of jobs
+    threads ahead of when they are needed.  Results are yielded
+    depth-first with files and subdirectories in sorted order, so the
+    order does not depend on jobs.
+
+    Parameters
+    ----------
+    root : string
+        Root path to begin searching for files that match the patterns
+    patterns : string
+        Patterns to search for, multiple patterns are separated by semicolon.
+    skip_dirs : SkipDirs or list
+        Directories to skip/ignore
+    jobs : int
+        Number of threads used to list directories.
+    exclude : string
+        Patterns of files to leave out, separated by semicolon.
+
+    """
+
+    if scandir is None:
+        for fn in all_dirs(root, patterns, skip_dirs=skip_dirs,
+                           exclude=exclude):
+            yield fn, os.stat(fn)
+        return
+    matcher = PatternMatcher(patterns, exclude)
+    if not isinstance(skip_dirs, SkipDirs):
+        skip_dirs = SkipDirs(skip_dirs)
+    if skip_dirs.skips_tree(root):
+        return
+    pool = None
+    if jobs > 1 and ThreadPool is not None:
+        pool = ThreadPool(jobs)
+    try:
+        def submit(path):
+            # Return a callable which returns the listing of path
+            if pool is None:
+                return partial(_list_dir, path, matcher)
+            return pool.apply_async(_list_dir, (path, matcher)).get
+        stack = [(root, submit(root))]
+        while stack:
+            path, listing = stack.pop()
+            files, subdirs = listing()
+            subdirs = skip_dirs.prune(path, subdirs)
+            # Submit the subdirectories in order so the pool lists
+            # them in the order we will visit them.
+            children = [(os.path.join(path, sdir),
+                         submit(os.path.join(path, sdir)))
+                        for sdir in subdirs]
+            for name, st in files:
+                yield os.path.join(path, name), st
+            # Push in reverse so the first subdirectory is popped first,
+            # this is the same depth-first order os.walk uses.
+            children.reverse()
+            stack.extend(children)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
 def validate_search_path(path):
     """Validate path passed in at command line."""
     search_path = os.path.abspath(os.path.expanduser(path))
@@ -237,39 +877,459 @@ def _clean_file_list(dir_list):
     # remove duplicates
     return set(dirs)
 
+def _clean_skip_dirs(dir_list):
+    """Clean the paths of directories to skip.
+
+    Like _clean_file_list, but paths with wildcards do not have to
+    exist.
+
+    Returns
+    -------
+    skip_dirs : SkipDirs
+
+    """
+
+    dirs = []
+    for dr in dir_list:
+        dr = dr.rstrip(os.path.sep)
+        if _is_literal(dr):
+            dirs.append(validate_search_path(dr))
+        else:
+            dirs.append(os.path.abspath(os.path.expanduser(dr)))
+    return SkipDirs(dirs)
+
 def get_file_list(search_path, patterns, skip_dirs):
     """Search the directories and return list of files that match the
     patterns."""
     filelist = list(all_dirs(search_path, patterns, skip_dirs=skip_dirs))
     return filelist
 
+def scan_paths(path_dirs, patterns, skip_dirs, jobs=None, exclude=''):
+    """Yield (filename, stat) for the files in all path_dirs that match
+    the patterns.
+
+    If jobs is None the directories are searched with all_dirs,
+    otherwise with scan_dirs using jobs threads.  Files that match
+    the exclude patterns are left out.
+
+    """
+
+    for pth in path_dirs:
+        if jobs is None:
+            for fn in all_dirs(pth, patterns, skip_dirs=skip_dirs,
+                               exclude=exclude):
+                yield fn, os.stat(fn)
+        else:
+            for fn, st in scan_dirs(pth, patterns, skip_dirs, jobs, exclude):
+                yield fn, st
+
+class RunningStats(object):
+    """File size statistics calculated in one pass in constant memory.
+
+    The mean and variance are updated with Welford's algorithm, and
+    the num largest files are kept in a heap.
+
+    Files are counted once per device and inode in the unique and
+    allocated totals.  To keep memory use down, only the inodes of
+    files with more than one link are remembered, so unlike
+    stats_summary bind mounted copies are counted more than once.
+
+    """
+
+    def __init__(self, num=0):
+        self.num = num
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.min = None
+        self.max = None
+        # Sum of squared differences from the mean
+        self._m2 = 0.0
+        self.unique_count = 0
+        self.unique_total = 0
+        self.allocated = 0
+        # (device, inode) of files with more than one link
+        self._linked = set()
+        # Heap of (size, filename, stat), smallest of the largest
+        # files first
+        self._largest = []
+
+    def add(self, filename, st):
+        """Add a file with stat result st to the statistics."""
+        size = st.st_size
+        self.count += 1
+        self.total += size
+        delta = size - self.mean
+        self.mean += delta / float(self.count)
+        self._m2 += delta * (size - self.mean)
+        if self.min is None or size < self.min:
+            self.min = size
+        if self.max is None or size > self.max:
+            self.max = size
+        # Every name of a file is listed, as without --stream
+        if len(self._largest) < self.num:
+            heapq.heappush(self._largest, (size, filename, st))
+        elif self.num and size > self._largest[0][0]:
+            heapq.heapreplace(self._largest, (size, filename, st))
+        if st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            if key in self._linked:
+                return
+            self._linked.add(key)
+        self.unique_count += 1
+        self.unique_total += size
+        self.allocated += stat_blocks(st) * 512
+
+    @property
+    def var(self):
+        # Population variance, the same as numpy's var
+        if self.count == 0:
+            return 0.0
+        return self._m2 / self.count
+
+    @property
+    def std(self):
+        return self.var ** 0.5
+
+    def largest(self):
+        """Return a FileTable of the num largest files, smallest to
+        largest."""
+        table = FileTable()
+        for size, fn, st in sorted(self._largest):
+            table.append(fn, st)
+        return table
+
+    def summary(self):
+        """Return the statistics as a dict, all 0 if no files were
+        added."""
+        return {'count': self.count, 'total': self.total,
+                'mean': self.mean, 'min': self.min or 0,
+                'max': self.max or 0,
+                'std': self.std, 'var': self.var,
+                'unique_count': self.unique_count,
+                'unique_total': self.unique_total,
+                'allocated': self.allocated}
+
+def stream_stats(scanned, num=0, interval=10.0):
+    """Calculate statistics of the files in scanned in one pass.
+
+    Parameters
+    ----------
+    scanned : iterable
+        (filename, stat) tuples, as yielded by scan_paths
+    num : int
+        Number of largest files to keep.
+    interval : float
+        Print a snapshot of the statistics to stderr every interval
+        seconds.  No snapshots are printed if interval is 0.
+
+    Returns
+    -------
+    running : RunningStats
+
+    """
+
+    running = RunningStats(num)
+    last = time.time()
+    for fn, st in scanned:
+        running.add(fn, st)
+        # Only look at the clock every 1024 files
+        if interval and running.count % 1024 == 0:
+            now = time.time()
+            if now - last >= interval:
+                last = now
+                sys.stderr.write('Scanned %d files, %d bytes, mean size %d\n'
+                                 % (running.count, running.total,
+                                    running.mean))
+    return running
+
 def _format_output(val, fmt='%d', rjust=20):
     return locale.format(fmt, val, True).rjust(rjust)
 
-def print_stats(size_array, patterns):
-    """Print file statistics for files in filelist."""
-    # Calculate some stats
-    asum = size_array['size'].sum()
-    amean = size_array['size'].mean()
-    amin = size_array['size'].min()
-    amax = size_array['size'].max()
-    astd = size_array['size'].std()
-    avar = size_array['size'].var()
+def stats_summary(table):
+    """Return file statistics for files in table as a dict.
+
+    The unique_count, unique_total and allocated statistics count hard
+    links and bind mounted copies of a file once.  allocated is the
+    space taken on disk, less than the size for sparse files.  All
+    statistics are 0 for an empty table.
+
+    """
+
+    sizes = table.size
+    if not len(sizes):
+        return RunningStats().summary()
+    unique = table.inode_groups()[0]
+    return {'count': len(sizes), 'total': int(sizes.sum()),
+            'mean': float(sizes.mean()), 'min': int(sizes.min()),
+            'max': int(sizes.max()), 'std': float(sizes.std()),
+            'var': float(sizes.var()),
+            'unique_count': int(unique.sum()),
+            'unique_total': int(sizes[unique].sum()),
+            'allocated': int(table.blocks[unique].sum()) * 512}
+
+def print_stats(table, patterns):
+    """Print file statistics for files in table."""
+    print_summary(stats_summary(table), patterns)
+
+def print_summary(summary, patterns):
+    """Print file statistics from stats_summary or RunningStats.summary."""
     # set internationalization settings to user defaults
     locale.setlocale(locale.LC_ALL, "")
     print 'Patterns matched:', patterns
-    print 'Number of files: ', _format_output(len(size_array), rjust=18)
-    print 'Total size:    ', _format_output(asum)
-    print 'Average size:  ', _format_output(amean)
-    print 'Minimum size:  ', _format_output(amin)
-    print 'Maximum size:  ', _format_output(amax)
-    print 'Standard dev:  ', _format_output(astd)
-    print 'Variance:      ', _format_output(int(avar))
-
-def print_files(size_array):
-    """Print given files and their sizes."""
-    for sz, fn in size_array:
-        print _format_output(sz, rjust=16), ' ', fn
+    print 'Number of files: ', _format_output(summary['count'], rjust=18)
+    print 'Total size:    ', _format_output(summary['total'])
+    print 'Average size:  ', _format_output(summary['mean'])
+    print 'Minimum size:  ', _format_output(summary['min'])
+    print 'Maximum size:  ', _format_output(summary['max'])
+    print 'Standard dev:  ', _format_output(summary['std'])
+    print 'Variance:      ', _format_output(int(summary['var']))
+    # Hard links and bind mounts counted once
+    print 'Unique files:    ', _format_output(summary['unique_count'],
+                                              rjust=18)
+    print 'Unique size:   ', _format_output(summary['unique_total'])
+    print 'Allocated size:', _format_output(summary['allocated'])
+    if 'headers' in summary:
+        print 'Image headers:   ', _format_output(summary['headers'], rjust=18)
+        print 'Total voxels:  ', _format_output(summary['voxels'])
+        print 'Total volumes: ', _format_output(summary['volumes'])
+        print 'Data size:     ', _format_output(summary['data_size'])
+        print 'Compression:   ', _format_output(summary['compression_ratio'],
+                                                fmt='%.2f')
+
+def _read_header(filename):
+    """Return the image header of filename, or None if it has none."""
+    try:
+        return read_header(filename)
+    except (HeaderError, EnvironmentError, zlib.error):
+        return None
+
+# Threads reading image headers.  Header reads are small and mostly
+# wait on the disk or network, so a few run in parallel by default.
+header_jobs = 4
+
+def read_headers(table, jobs=header_jobs):
+    """Read the image header of each file in table.
+
+    Only the header of each file is read, with jobs threads.  The
+    header fields are added to table as columns:
+
+    ndim
+        Number of dimensions, 0 if the file has no header.
+    shape
+        Size of each dimension, an array of 7 columns padded with 0.
+    datatype
+        NIfTI datatype code, -1 if the file has no header.
+    nvoxels
+        Number of voxels.
+    volumes
+        Number of volumes (timepoints), 1 for 3D images.
+    data_size
+        Size of the voxel data in bytes, uncompressed.
+
+    """
+
+    nfiles = len(table)
+    ndim = np.zeros(nfiles, np.int16)
+    shape = np.zeros((nfiles, 7), np.int64)
+    datatype = np.empty(nfiles, np.int16)
+    datatype.fill(-1)
+    nvoxels = np.zeros(nfiles, np.int64)
+    volumes = np.zeros(nfiles, np.int64)
+    data_size = np.zeros(nfiles, np.int64)
+
+    pool = None
+    map_func = map
+    if jobs > 1 and ThreadPool is not None:
+        pool = ThreadPool(jobs)
+        map_func = partial(pool.imap, chunksize=16)
+    try:
+        headers = map_func(_read_header, table.filenames())
+        for i, hdr in enumerate(headers):
+            if hdr is None:
+                continue
+            ndim[i] = len(hdr.dim)
+            shape[i, :ndim[i]] = hdr.dim
+            datatype[i] = hdr.datatype
+            nvoxels[i] = hdr.nvoxels
+            volumes[i] = hdr.ntimepoints
+            data_size[i] = hdr.data_nbytes
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    table.set_column('ndim', ndim)
+    table.set_column('shape', shape)
+    table.set_column('datatype', datatype)
+    table.set_column('nvoxels', nvoxels)
+    table.set_column('volumes', volumes)
+    table.set_column('data_size', data_size)
+
+def header_summary(table):
+    """Return statistics of the image headers read by read_headers.
+
+    compression_ratio is the uncompressed data size of the gzipped
+    images over their size on disk, 0 if there are none.
+
+    """
+
+    has_header = table.extra['datatype'] >= 0
+    data_size = table.extra['data_size']
+    gzipped = np.array([table.name(i).endswith('.gz')
+                        for i in xrange(len(table))], bool)
+    gzipped &= has_header
+    ratio = 0.0
+    gz_size = table.size[gzipped].sum()
+    if gz_size:
+        ratio = data_size[gzipped].sum() / float(gz_size)
+    return {'headers': int(has_header.sum()),
+            'voxels': int(table.extra['nvoxels'].sum()),
+            'volumes': int(table.extra['volumes'].sum()),
+            'data_size': int(data_size.sum()),
+            'compression_ratio': ratio}
+
+def datatype_breakdown(table):
+    """Total file sizes per image datatype.
+
+    Returns
+    -------
+    breakdown : list
+        (total size, number of files, datatype) tuples, largest first.
+
+    """
+
+    codes = table.extra['datatype']
+    groups, counts, totals = table.group_totals(codes.astype(np.int64) + 1)
+    breakdown = []
+    for grp, count, total in zip(groups, counts, totals):
+        if grp == 0:
+            name = '(no header)'
+        else:
+            name = datatypes.get(grp - 1, ('unknown %d' % (grp - 1),))[0]
+        breakdown.append((int(total), int(count), name))
+    breakdown.sort(reverse=True)
+    return breakdown
+
+def _dir_key(dirname, roots, depth):
+    """Return the directory at most depth levels below one of the roots
+    that dirname is in."""
+    for root in roots:
+        if dirname == root or dirname.startswith(root.rstrip(os.path.sep) +
+                                                 os.path.sep):
+            rel = dirname[len(root):].strip(os.path.sep)
+            parts = []
+            if rel:
+                parts = rel.split(os.path.sep)[:depth]
+            return os.path.join(root, *parts)
+    return dirname
+
+def dir_breakdown(table, roots, depth=1):
+    """Total file sizes per directory, depth levels below the roots.
+
+    Each file is counted in the directory that contains it, depth
+    levels below the search path (one of roots) it was found in.
+    Files less deep are counted in their own directory.
+
+    Returns
+    -------
+    breakdown : list
+        (total size, number of files, directory) tuples, largest first.
+
+    """
+
+    # Longest roots first so nested search paths match the deepest one
+    roots = sorted(roots, key=len, reverse=True)
+    keys = []
+    key_ids = {}
+    dir_group = np.empty(len(table.dirs), np.int64)
+    for i, dirname in enumerate(table.dirs):
+        key = _dir_key(dirname, roots, depth)
+        if key not in key_ids:
+            key_ids[key] = len(keys)
+            keys.append(key)
+        dir_group[i] = key_ids[key]
+    groups, counts, totals = table.group_totals(dir_group[table.dir_id])
+    breakdown = [(int(total), int(count), keys[grp])
+                 for grp, count, total in zip(groups, counts, totals)]
+    breakdown.sort(reverse=True)
+    return breakdown
+
+def pattern_breakdown(table, patterns):
+    """Total file sizes per pattern.
+
+    Each file is counted for the first of the patterns it matches,
+    the same pattern that selected it when searching.
+
+    Returns
+    -------
+    breakdown : list
+        (total size, number of files, pattern) tuples, largest first.
+
+    """
+
+    matcher = PatternMatcher(patterns)
+    keys = np.empty(len(table), np.int64)
+    for i in xrange(len(table)):
+        keys[i] = matcher.pattern_index(table.name(i))
+    # Files that match no pattern get index -1, count them last
+    keys[keys < 0] = len(matcher.patterns)
+    labels = matcher.patterns + ['(other)']
+    groups, counts, totals = table.group_totals(keys)
+    breakdown = [(int(total), int(count), labels[grp])
+                 for grp, count, total in zip(groups, counts, totals)]
+    breakdown.sort(reverse=True)
+    return breakdown
+
+def print_breakdown(breakdown, title):
+    """Print the totals returned by dir_breakdown or pattern_breakdown."""
+    grand_total = sum(total for total, count, name in breakdown)
+    print title
+    print '%20s %12s %7s  %s' % ('Total size', 'Files', '%', 'Name')
+    for total, count, name in breakdown:
+        percent = 100.0
+        if grand_total:
+            percent = 100.0 * total / grand_total
+        print _format_output(total), _format_output(count, rjust=12), \
+            '%7.2f ' % percent, name
+
+def print_files(table, indices=None):
+    """Print given files and their sizes.
+
+    Prints the files of table at indices, or all files if indices is
+    None.
+
+    """
+
+    if indices is None:
+        indices = xrange(len(table))
+    sizes = table.size
+    for i in indices:
+        print _format_output(sizes[i], rjust=16), ' ', table.filename(i)
+
+class TextWriter(object):
+    """Print results as text, for people to read.
+
+    Has the same methods as the writers in file_output.
+
+    """
+
+    def stats(self, summary, patterns):
+        print_summary(summary, patterns)
+
+    def files(self, table, indices):
+        print
+        print_files(table, indices)
+
+    def breakdown(self, kind, breakdown):
+        print
+        title = 'Size by %s:' % {'dir': 'directory'}.get(kind, kind)
+        print_breakdown(breakdown, title)
+
+    def duplicates(self, groups):
+        find_duplicate_files(dict((digest, files) for files, digest in groups))
+
+    def close(self):
+        pass
 
 def main(argv=None):
     if argv is None:
@@ -285,15 +1345,70 @@ def main(argv=None):
                         help='Filename patterns to search for [*.nii*;*.img*]')
     list_help = 'Print NUM largest files matching the patterns' \
         ' or all files if NUM is not supplied'
+    parser.add_argument('-x', '--exclude', default='',
+                        help='Filename patterns of files to leave out, '
+                        'separated by semicolon')
     parser.add_argument('-n', '--num', nargs='?', default=False, 
                         help=list_help)
     parser.add_argument('--debug', action='store_true',
                         help='Print out some debugging info.')
-    md5_help = 'Find duplicate files. (SLOW) ' \
-        'Performs md5 calculation on files and looks for matches'
+    md5_help = 'Find duplicate files. ' \
+        'Performs md5 calculation on files of the same size and ' \
+        'looks for matches'
     parser.add_argument('-m', '--md5', action='store_true', help=md5_help)
+    index_help = 'Keep md5 hashes in an index and only hash files ' \
+        'that changed since the last run [%s]' % default_index_path()
+    algo_help = 'Hash algorithm used to find duplicate files, one of ' \
+        '%s [md5]' % ', '.join(digest_algorithms)
+    parser.add_argument('--hash-algo', default='md5',
+                        choices=digest_algorithms, help=algo_help)
+    partial_help = 'Hash algorithm used on the first and last %d MB ' \
+        'of files to find candidate duplicates.  Defaults to --hash-algo' \
+        % (partial_hash_size / 1024 / 1024)
+    parser.add_argument('--partial-algo', choices=sorted(hash_algorithms),
+                        help=partial_help)
+    parser.add_argument('--hash-jobs', type=int, default=1, metavar='NUM',
+                        help='Hash files with NUM processes [1]')
+    parser.add_argument('--index', nargs='?', const=default_index_path(),
+                        metavar='FILE', help=index_help)
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='Discard the index and hash all files again')
     parser.add_argument('-d', '--skip-dirs', nargs='*', default='',
-                        help='Ignore/skip these directories')
+                        help='Ignore/skip these directories, which may '
+                        'contain wildcards')
+    jobs_help = 'Scan directories with NUM threads, using scandir to ' \
+        'avoid stat\'ing files more than once'
+    parser.add_argument('-j', '--jobs', type=int, metavar='NUM',
+                        help=jobs_help)
+    format_help = 'Output format, one of text, %s [text]' % \
+        ', '.join(sorted(writers))
+    parser.add_argument('-f', '--format', default='text',
+                        choices=['text'] + sorted(writers), help=format_help)
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write json, csv or npz results to FILE '
+                        'instead of stdout, '
+                        'required with --format npz')
+    parser.add_argument('--by-dir', type=int, metavar='DEPTH',
+                        help='Print total sizes per directory, DEPTH '
+                        'levels below the search paths')
+    parser.add_argument('--by-pattern', action='store_true',
+                        help='Print total sizes per pattern')
+    headers_help = 'Read the NIfTI/Analyze header of each file and ' \
+        'print voxel counts and total sizes per datatype.  Headers are ' \
+        'read with --header-jobs threads'
+    parser.add_argument('--headers', action='store_true', help=headers_help)
+    parser.add_argument('--header-jobs', type=int, default=header_jobs,
+                        metavar='NUM', help='Read headers with NUM '
+                        'threads [%d]' % header_jobs)
+    stream_help = 'Calculate statistics in one pass in constant memory, ' \
+        'for very large trees.  Requires NUM with -n, cannot find ' \
+        'duplicate files'
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help=stream_help)
+    parser.add_argument('--progress', type=float, default=10.0,
+                        metavar='SECS',
+                        help='With --stream, print progress every SECS '
+                        'seconds to stderr, 0 to disable [10]')
     parser.add_argument('--doc', action='store_true',
                         help='Print extended documentation.')
     args = parser.parse_args()
@@ -303,38 +1418,104 @@ def main(argv=None):
         print __doc__
         return
 
-    skip_dirs = _clean_file_list(args.skip_dirs)
+    if args.format == 'npz' and args.output is None:
+        parser.error('--format npz requires --output')
+    if args.format == 'text' and args.output is not None:
+        parser.error('--output requires --format json, csv or npz')
+    if args.stream:
+        if args.md5:
+            parser.error('--stream cannot be used with --md5')
+        if args.num is None:
+            parser.error('--stream cannot list all files, give -n NUM')
+        if args.by_dir is not None or args.by_pattern or args.headers:
+            parser.error('--stream cannot be used with --by-dir, '
+                         '--by-pattern or --headers')
+
+    skip_dirs = _clean_skip_dirs(args.skip_dirs)
     path_dirs = _clean_file_list(args.path)
-    filelist = []
-    for pth in path_dirs:
-        tmplist = get_file_list(pth, args.patterns, skip_dirs)
-        filelist.extend(tmplist)
+    scanned = scan_paths(path_dirs, args.patterns, skip_dirs, args.jobs,
+                         args.exclude)
 
-    if not filelist:
-        # No files to process
-        return
+    if args.stream:
+        num = 0
+        if args.num is not False:
+            num = int(args.num)
+        running = stream_stats(scanned, num, args.progress)
+        if running.count == 0 and args.format == 'text':
+            # No files to process
+            return
+        summary = running.summary()
+        table = running.largest()
+    else:
+        table = FileTable()
+        for fn, st in scanned:
+            table.append(fn, st)
+        if not len(table) and args.format == 'text':
+            # No files to process.  Other formats still write a
+            # document, with a count of 0.
+            return
+        summary = stats_summary(table)
+        if args.headers:
+            read_headers(table, args.header_jobs)
+            summary.update(header_summary(table))
 
-    # Get file sizes
-    size_array = file_sizes(filelist)
+    fp = None
+    if args.format == 'text':
+        writer = TextWriter()
+    else:
+        if args.output is None:
+            fp = sys.stdout
+        else:
+            fp = open(args.output, 'wb')
+        writer = writers[args.format](fp)
 
-    print_stats(size_array, args.patterns)
+    writer.stats(summary, args.patterns)
 
     if args.num is not False:
+        # Indices of the files from smallest to largest
+        order = table.argsort('size')
         if args.num is None:
             # print whole list
-            selected = size_array
+            selected = order
         else:
             # print only requested amount
             n = int(args.num)
-            selected = size_array[-n:]
-        print
-        print_files(selected)
+            selected = order[-n:]
+        writer.files(table, selected)
+
+    if args.by_dir is not None:
+        writer.breakdown('dir', dir_breakdown(table, path_dirs, args.by_dir))
+
+    if args.by_pattern:
+        writer.breakdown('pattern', pattern_breakdown(table, args.patterns))
+
+    if args.headers:
+        writer.breakdown('datatype', datatype_breakdown(table))
 
     # Check for duplicate files
     if args.md5:
-        print '\nAnalyzing files, looking for duplicates...'
-        hashed_files = file_hashes(filelist)
-        find_duplicate_files(hashed_files)
+        if args.format == 'text':
+            print '\nAnalyzing files, looking for duplicates...'
+        index = None
+        if args.index is not None or args.rebuild_index:
+            from file_index import FileIndex
+            try:
+                index = FileIndex(args.index, rebuild=args.rebuild_index)
+            except ImportError, err:
+                parser.error(str(err))
+        try:
+            hashed_files = duplicate_hashes(table, index,
+                                            args.hash_algo,
+                                            args.partial_algo,
+                                            args.hash_jobs)
+        finally:
+            if index is not None:
+                index.close()
+        writer.duplicates(duplicate_groups(hashed_files))
+
+    writer.close()
+    if fp is not None and fp is not sys.stdout:
+        fp.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,281 @@
+"""Compact columnar table of files used by file_stats.py.
+
+Numeric columns are numpy arrays.  Paths are split into a table of
+unique directories, referenced by an int32 id per file, and the
+basenames, which are stored concatenated in one string indexed by an
+array of offsets.  Memory use is a few dozen bytes per file instead of
+the length of the longest path.
+
+"""
+
+import os
+
+import numpy as np
+
+def stat_blocks(st):
+    """Return the 512 byte blocks allocated to the file with stat
+    result st.
+
+    st_blocks is not available on all platforms, there the size is
+    rounded up to whole blocks.
+
+    """
+
+    blocks = getattr(st, 'st_blocks', None)
+    if blocks is None:
+        blocks = (st.st_size + 511) // 512
+    return blocks
+
+class FileTable(object):
+    """Columnar table of files.
+
+    Rows are appended with append() in scan order and are never
+    reordered; use argsort() to get an order to read them in.
+
+    Attributes
+    ----------
+    dirs : list
+        Unique directory names.
+    dir_id : numpy.ndarray
+        Index into dirs of the directory of each file.
+    names : string
+        Basenames of all files concatenated.
+    name_offsets : numpy.ndarray
+        Basename of file i is names[name_offsets[i]:name_offsets[i+1]].
+    size : numpy.ndarray
+        Size of each file in bytes, int64.
+    mtime : numpy.ndarray
+        Modification time of each file in seconds since the epoch, int64.
+    dev, inode : numpy.ndarray
+        Device and inode of each file, int64.  Hard links and bind
+        mounted copies of a file have the same device and inode.  An
+        inode of 0 means it is unknown.
+    blocks : numpy.ndarray
+        Number of 512 byte blocks allocated to each file, int64.  Less
+        than size / 512 for sparse files.
+    extra : dict
+        Columns added with set_column, by name.
+
+    """
+
+    # Rows are buffered in lists and converted to arrays in chunks of
+    # this many rows.
+    chunk_size = 65536
+
+    # Numeric columns and their dtypes
+    columns = [('dir_id', np.int32), ('size', np.int64), ('mtime', np.int64),
+               ('dev', np.int64), ('inode', np.int64), ('blocks', np.int64)]
+
+    def __init__(self):
+        self.dirs = []
+        self._dir_ids = {}
+        self._pending = []
+        self._chunks = []
+        self._name_chunks = []
+        self._arrays = None
+        self.extra = {}
+
+    def append(self, path, st):
+        """Add the file path with stat result st to the table."""
+        dirname, name = os.path.split(path)
+        dir_id = self._dir_ids.get(dirname)
+        if dir_id is None:
+            dir_id = len(self.dirs)
+            self._dir_ids[dirname] = dir_id
+            self.dirs.append(dirname)
+        self._pending.append((name, dir_id, st.st_size, int(st.st_mtime),
+                              st.st_dev, st.st_ino, stat_blocks(st)))
+        if len(self._pending) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        """Convert the pending rows into a chunk of arrays."""
+        if not self._pending:
+            return
+        names = [row[0] for row in self._pending]
+        chunk = {'name_length': np.array([len(nm) for nm in names], np.int64)}
+        for i, (col, dtype) in enumerate(self.columns):
+            chunk[col] = np.array([row[i + 1] for row in self._pending], dtype)
+        self._chunks.append(chunk)
+        self._name_chunks.append(''.join(names))
+        self._pending = []
+        self._arrays = None
+
+    def _get_arrays(self):
+        """Return a dict of the full columns, concatenating chunks once."""
+        if self._pending:
+            self._flush()
+        if self._arrays is None:
+            if len(self._chunks) != 1:
+                # Merge into one chunk so later calls do not copy again
+                chunk = {}
+                for col in ['name_length'] + [c for c, dt in self.columns]:
+                    dtype = dict(self.columns).get(col, np.int64)
+                    chunk[col] = np.concatenate([np.empty(0, dtype)] +
+                                                [c[col] for c in self._chunks])
+                self._chunks = [chunk]
+                self._name_chunks = [''.join(self._name_chunks)]
+            arrays = dict(self._chunks[0])
+            offsets = np.zeros(len(arrays['name_length']) + 1, np.int64)
+            np.cumsum(arrays['name_length'], out=offsets[1:])
+            arrays['name_offsets'] = offsets
+            arrays['names'] = self._name_chunks[0]
+            self._arrays = arrays
+        return self._arrays
+
+    dir_id = property(lambda self: self._get_arrays()['dir_id'])
+    size = property(lambda self: self._get_arrays()['size'])
+    mtime = property(lambda self: self._get_arrays()['mtime'])
+    dev = property(lambda self: self._get_arrays()['dev'])
+    inode = property(lambda self: self._get_arrays()['inode'])
+    blocks = property(lambda self: self._get_arrays()['blocks'])
+    names = property(lambda self: self._get_arrays()['names'])
+    name_offsets = property(lambda self: self._get_arrays()['name_offsets'])
+
+    def set_column(self, name, values):
+        """Add the column name to the table.
+
+        values has one row for each file.  Add columns after all files
+        have been appended.
+
+        """
+
+        values = np.asarray(values)
+        if len(values) != len(self):
+            raise ValueError('Column %s has %d rows, table has %d'
+                             % (name, len(values), len(self)))
+        self.extra[name] = values
+
+    def arrays(self):
+        """Return the table as a dict of numpy arrays.
+
+        The directory names and basenames are stored as uint8 arrays
+        ('dirs' indexed by 'dir_offsets', 'names' by 'name_offsets'),
+        so the dict can be saved with np.savez and turned back into a
+        table with from_arrays without any parsing.  Columns added
+        with set_column are stored with a 'col_' prefix.
+
+        """
+
+        arrays = self._get_arrays()
+        out = dict((col, arrays[col]) for col, dtype in self.columns)
+        out['names'] = np.frombuffer(arrays['names'], np.uint8)
+        out['name_offsets'] = arrays['name_offsets']
+        dir_offsets = np.zeros(len(self.dirs) + 1, np.int64)
+        np.cumsum([len(dr) for dr in self.dirs], out=dir_offsets[1:])
+        out['dirs'] = np.frombuffer(''.join(self.dirs), np.uint8)
+        out['dir_offsets'] = dir_offsets
+        for name, values in self.extra.iteritems():
+            out['col_' + name] = values
+        return out
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Create a table from the dict returned by arrays(), or the
+        NpzFile of a saved one."""
+        table = cls()
+        dirs = arrays['dirs'].tostring()
+        offsets = arrays['dir_offsets']
+        table.dirs = [dirs[offsets[i]:offsets[i + 1]]
+                      for i in xrange(len(offsets) - 1)]
+        table._dir_ids = dict((dr, i) for i, dr in enumerate(table.dirs))
+        chunk = dict((col, arrays[col]) for col, dtype in cls.columns)
+        chunk['name_length'] = np.diff(arrays['name_offsets'])
+        table._chunks = [chunk]
+        table._name_chunks = [arrays['names'].tostring()]
+        for key in arrays.keys():
+            if key.startswith('col_'):
+                table.extra[key[4:]] = arrays[key]
+        return table
+
+    def __len__(self):
+        return sum(len(c['size']) for c in self._chunks) + len(self._pending)
+
+    def name(self, i):
+        """Return the basename of file i."""
+        arrays = self._get_arrays()
+        offsets = arrays['name_offsets']
+        return arrays['names'][offsets[i]:offsets[i + 1]]
+
+    def filename(self, i):
+        """Return the full path of file i."""
+        return os.path.join(self.dirs[self.dir_id[i]], self.name(i))
+
+    def filenames(self, indices=None):
+        """Yield the full path of each file in indices, or of all
+        files if indices is None."""
+        if indices is None:
+            indices = xrange(len(self))
+        for i in indices:
+            yield self.filename(i)
+
+    def argsort(self, column='size'):
+        """Return the indices that sort the table on column.
+
+        The sort is stable, so files with equal values stay in scan
+        order.
+
+        """
+
+        return np.argsort(getattr(self, column), kind='mergesort')
+
+    def group_totals(self, keys):
+        """Total the sizes of the files per group.
+
+        Parameters
+        ----------
+        keys : numpy.ndarray
+            Non-negative integer group of each file.
+
+        Returns
+        -------
+        groups : numpy.ndarray
+            The groups which have at least one file, in increasing order.
+        counts : numpy.ndarray
+            Number of files in each group.
+        totals : numpy.ndarray
+            Total size of the files in each group, int64.
+
+        """
+
+        keys = np.asarray(keys)
+        if len(keys) == 0:
+            empty = np.empty(0, np.int64)
+            return empty, empty, empty
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(
+            ([True], sorted_keys[1:] != sorted_keys[:-1])))
+        groups = sorted_keys[starts]
+        counts = np.diff(np.concatenate((starts, [len(keys)])))
+        totals = np.add.reduceat(self.size[order], starts)
+        return groups, counts, totals
+
+    def inode_groups(self):
+        """Find files which are the same file on disk.
+
+        Returns
+        -------
+        first : numpy.ndarray
+            Boolean mask, True for the first file (in scan order) of
+            each device and inode, and for files with unknown inode.
+        groups : list
+            Index arrays of the files that share a device and inode,
+            for each device and inode with more than one file.
+
+        """
+
+        first = np.ones(len(self), bool)
+        known = np.flatnonzero(self.inode != 0)
+        # lexsort is stable, so each group starts with its first file
+        order = known[np.lexsort((self.inode[known], self.dev[known]))]
+        dev = self.dev[order]
+        inode = self.inode[order]
+        same = (dev[1:] == dev[:-1]) & (inode[1:] == inode[:-1])
+        first[order[1:][same]] = False
+        starts = np.flatnonzero(np.concatenate(([True], ~same)))
+        stops = np.concatenate((starts[1:], [len(order)]))
+        groups = [order[start:stop] for start, stop in zip(starts, stops)
+                  if stop - start > 1]
+        return first, groups
+
@@ -0,0 +1,148 @@
+"""Random access to the uncompressed contents of gzip files.
+
+gzip files can only be decompressed from the start.  A GzipIndex
+decompresses the file once and keeps access points every `spacing`
+bytes of output, in the style of zlib's zran.c example.  An access
+point is a copy of the decompressor state, so reading a range of the
+uncompressed data only decompresses from the access point before it.
+
+The access points are copies of zlib decompressor objects, which
+cannot be saved to disk (Python's zlib has no inflatePrime), so
+indexes are cached per process with get_index instead of next to the
+file.
+
+"""
+
+import os
+import zlib
+import bisect
+
+# Bytes of compressed data fed to the decompressor at a time
+read_size = 64 * 1024
+
+# Default bytes of uncompressed data between access points
+default_spacing = 4 * 1024 * 1024
+
+# Tell zlib to expect a gzip header
+_gzip_wbits = 16 + zlib.MAX_WBITS
+
+class GzipIndex(object):
+    """Index of access points into the gzip file filename.
+
+    Parameters
+    ----------
+    filename : string
+        The gzip file.
+    spacing : int
+        Bytes of uncompressed data between access points.
+
+    Attributes
+    ----------
+    size : int
+        Size of the uncompressed data in bytes.
+
+    """
+
+    def __init__(self, filename, spacing=default_spacing):
+        self.filename = filename
+        self.spacing = spacing
+        # Uncompressed offsets of the access points, and the
+        # (compressed offset, decompressor) at each.
+        self._offsets = []
+        self._points = []
+        self.size = 0
+        self._build()
+
+    def _build(self):
+        """Decompress the whole file once, recording access points."""
+        fp = open(self.filename, 'rb')
+        try:
+            dobj = zlib.decompressobj(_gzip_wbits)
+            comp_offset = 0
+            out_offset = 0
+            next_point = 0
+            while True:
+                if out_offset >= next_point:
+                    # The decompressor has consumed all input so far
+                    # and produced all its output, a clean state to
+                    # restart from.
+                    self._offsets.append(out_offset)
+                    self._points.append((comp_offset, dobj.copy()))
+                    next_point = out_offset + self.spacing
+                chunk = fp.read(read_size)
+                if not chunk:
+                    break
+                comp_offset += len(chunk)
+                out_offset += len(dobj.decompress(chunk))
+                while dobj.unused_data:
+                    # Start of another gzip member
+                    rest = dobj.unused_data
+                    dobj = zlib.decompressobj(_gzip_wbits)
+                    out_offset += len(dobj.decompress(rest))
+            self.size = out_offset
+        finally:
+            fp.close()
+
+    def read(self, offset, length):
+        """Return length bytes of uncompressed data from offset.
+
+        Only the data from the last access point before offset is
+        decompressed.
+
+        """
+
+        if length <= 0:
+            return ''
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        out_offset = self._offsets[i]
+        comp_offset, dobj = self._points[i]
+        dobj = dobj.copy()
+        pieces = []
+        skip = offset - out_offset
+        wanted = length
+        fp = open(self.filename, 'rb')
+        try:
+            fp.seek(comp_offset)
+            while wanted > 0:
+                chunk = fp.read(read_size)
+                if not chunk:
+                    break
+                data = dobj.decompress(chunk)
+                while dobj.unused_data:
+                    rest = dobj.unused_data
+                    dobj = zlib.decompressobj(_gzip_wbits)
+                    data += dobj.decompress(rest)
+                if skip >= len(data):
+                    skip -= len(data)
+                    continue
+                data = data[skip:skip + wanted]
+                skip = 0
+                wanted -= len(data)
+                pieces.append(data)
+        finally:
+            fp.close()
+        return ''.join(pieces)
+
+# GzipIndex objects by (filename, size, mtime)
+_indexes = {}
+
+def get_index(filename, spacing=None):
+    """Return the GzipIndex of filename, building it if this process
+    has not indexed the current version of the file yet.
+
+    If spacing is None an existing index is used whatever its spacing,
+    and a new one gets default_spacing.
+
+    """
+
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    key = (filename, st.st_size, st.st_mtime)
+    index = _indexes.get(key)
+    if index is None or spacing not in (None, index.spacing):
+        # Drop indexes of older versions of the file
+        for old in [k for k in _indexes if k[0] == filename]:
+            del _indexes[old]
+        index = GzipIndex(filename, spacing or default_spacing)
+        _indexes[key] = index
+    return index
@@ -1,11 +1,410 @@
 """Interface to nipy image."""
 
+import bisect
+import gzip
+import threading
+
+import numpy as np
+
 from nipype.externals import pynifti
 
+from nifti_header import read_header, HeaderError
+from gzip_index import get_index
+
+def data_filename(filename):
+    """Return the file that holds the voxel data of the image filename.
+
+    A .nii file holds its own data, the data of a .hdr file is in the
+    .img file next to it.
+
+    """
+
+    for ext in ('.hdr', '.hdr.gz'):
+        if filename.endswith(ext):
+            return filename[:-len(ext)] + '.img' + ext[4:]
+    return filename
+
+def _expand_index(index, ndim):
+    """Return index as a tuple of ndim integers and slices, or None if
+    it uses fancy indexing or np.newaxis."""
+    if not isinstance(index, tuple):
+        index = (index,)
+    ellipses = [i for i, idx in enumerate(index) if idx is Ellipsis]
+    if ellipses:
+        i = ellipses[0]
+        fill = (slice(None),) * (ndim - len(index) + 1)
+        index = index[:i] + fill + index[i + 1:]
+    if len(index) > ndim:
+        return None
+    index = index + (slice(None),) * (ndim - len(index))
+    for i in index:
+        if not isinstance(i, (slice, int, long, np.integer)):
+            return None
+    return index
+
+def ras_orientation(affine):
+    """Find the voxel axes closest to the R, A and S world axes.
+
+    Parameters
+    ----------
+    affine : array
+        4x4 voxel to world (RAS+) transform of the image.
+
+    Returns
+    -------
+    axes : tuple
+        Voxel axis running along R, A and S.
+    flips : tuple
+        True for each of R, A and S whose voxel axis runs the other way,
+        towards L, P or I.
+
+    """
+
+    signed = np.asarray(affine, np.float64)[:3, :3]
+    norms = np.sqrt((signed ** 2).sum(axis=0))
+    norms[norms == 0] = 1
+    signed = signed / norms
+    work = np.abs(signed)
+    axes = [0, 1, 2]
+    flips = [False, False, False]
+    # Pair world and voxel axes greedily, closest pair first, so
+    # oblique images still get a permutation.
+    for k in range(3):
+        world, vox = np.unravel_index(np.argmax(work), work.shape)
+        axes[world] = vox
+        flips[world] = bool(signed[world, vox] < 0)
+        work[world, :] = -1
+        work[:, vox] = -1
+    return tuple(axes), tuple(flips)
+
+# Displayed slices: the RAS axis fixed by the slice, and the RAS axes
+# along the rows and the columns of the returned 2D array.
+slice_axes = {'sagittal': (0, 2, 1), 'coronal': (1, 2, 0),
+              'axial': (2, 1, 0)}
+
+class VolumeProxy(object):
+    """Lazy access to the voxel data of an image.
+
+    Indexing the proxy reads only the voxels that are asked for.  The
+    data of uncompressed images is memory-mapped from the file at the
+    header's vox_offset, so opening an image costs the same whatever
+    its size.  Other images are read in full the first time they are
+    indexed.  Gzipped data with a known datatype is read through a
+    gzip_index.GzipIndex, so indexing decompresses only the span of the
+    file that holds the requested voxels: an axial slice is a small
+    span, a sagittal slice needs most of the volume.
+
+    Values are scaled by the header's scl_slope and scl_inter, like
+    get_data does.
+
+    """
+
+    def __init__(self, filename, img):
+        self.filename = filename
+        self.img = img
+        self._array = None
+        self.header = None
+        try:
+            self.header = read_header(filename)
+        except (HeaderError, EnvironmentError):
+            pass
+
+    @property
+    def is_gzip_indexed(self):
+        """True if the data is read through a gzip index."""
+        hdr = self.header
+        return hdr is not None and hdr.dtype is not None and \
+            data_filename(self.filename).endswith('.gz')
+
+    def _get_array(self):
+        """Return the unscaled memmap, or the full scaled data."""
+        if self._array is None:
+            hdr = self.header
+            datafile = data_filename(self.filename)
+            if hdr is not None and hdr.dtype is not None and \
+                    not datafile.endswith('.gz'):
+                # NIfTI data is stored with x changing fastest
+                self._array = np.memmap(datafile, dtype=hdr.dtype, mode='r',
+                                        offset=hdr.vox_offset,
+                                        shape=hdr.shape, order='F')
+            else:
+                self._array = self.img.get_data()
+        return self._array
+
+    @property
+    def is_mapped(self):
+        """True if the data is read from a memmap."""
+        return isinstance(self._get_array(), np.memmap)
+
+    @property
+    def shape(self):
+        return self.img.get_shape()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _scale(self, data):
+        """Return data read from the file in native byte order, with
+        scaling applied.
+
+        Unscaled native data is returned as a view of what was read,
+        without copying.
+
+        """
+
+        slope = self.header.scl_slope
+        inter = self.header.scl_inter
+        # A zero or non-finite slope means no scaling, whatever the
+        # intercept, and a non-finite intercept means none, as in
+        # nibabel
+        if slope == 0 or not np.isfinite(slope):
+            slope, inter = 1, 0
+        if not np.isfinite(inter):
+            inter = 0
+        scaled = slope != 1 or inter != 0
+        if data.dtype.isnative and not scaled:
+            return data.view(np.ndarray)
+        data = np.array(data, dtype=data.dtype.newbyteorder('='))
+        if scaled:
+            data = data * slope + inter
+        return data
+
+    def _read_gzip(self, index):
+        """Return data[index], decompressing only the part of the file
+        that holds it."""
+        hdr = self.header
+        shape = tuple(hdr.shape)
+        dtype = np.dtype(hdr.dtype)
+        gz = get_index(data_filename(self.filename))
+        expanded = _expand_index(index, len(shape))
+        if expanded is None:
+            # Fancy indexing, read everything
+            count = int(np.prod(shape))
+            buf = gz.read(hdr.vox_offset, count * dtype.itemsize)
+            return np.ndarray(shape, dtype, buf, order='F')[index]
+        # Elements between consecutive values of each index
+        strides = [1]
+        for size in shape[:-1]:
+            strides.append(strides[-1] * size)
+        # Integer indices on the slowest changing axes pick one
+        # contiguous block, the next axis narrows it to a range.
+        start = 0
+        axis = len(shape) - 1
+        while axis >= 0 and not isinstance(expanded[axis], slice):
+            i = expanded[axis]
+            if i < 0:
+                i += shape[axis]
+            if not 0 <= i < shape[axis]:
+                raise IndexError('index %d out of bounds for axis %d'
+                                 % (expanded[axis], axis))
+            start += i * strides[axis]
+            axis -= 1
+        if axis < 0:
+            buf = gz.read(hdr.vox_offset + start * dtype.itemsize,
+                          dtype.itemsize)
+            return np.frombuffer(buf, dtype)[0]
+        first, stop, step = expanded[axis].indices(shape[axis])
+        if step > 0 and stop > first:
+            last = first + (stop - first - 1) // step * step
+            rng = slice(0, last - first + 1, step)
+        else:
+            first, last, rng = 0, shape[axis] - 1, expanded[axis]
+        start += first * strides[axis]
+        count = (last - first + 1) * strides[axis]
+        buf = gz.read(hdr.vox_offset + start * dtype.itemsize,
+                      count * dtype.itemsize)
+        block = np.ndarray(shape[:axis] + (last - first + 1,), dtype, buf,
+                           order='F')
+        return block[expanded[:axis] + (rng,)]
+
+    def __getitem__(self, index):
+        if self.is_gzip_indexed:
+            return self._scale(np.asarray(self._read_gzip(index)))
+        arr = self._get_array()
+        data = arr[index]
+        if isinstance(arr, np.memmap):
+            data = self._scale(data)
+        return data
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def stream_volume(self, tindex=0):
+        """Return volume tindex of gzipped data, decompressed in one
+        pass from the start of the file.
+
+        The gzip index is neither built nor used: building it is a
+        pass over the whole file itself, so for a single read of a
+        file this is about twice as fast.
+
+        """
+
+        hdr = self.header
+        shape = tuple(hdr.shape[:3])
+        dtype = np.dtype(hdr.dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        fp = gzip.open(data_filename(self.filename), 'rb')
+        try:
+            skip = hdr.vox_offset + tindex * nbytes
+            while skip > 0:
+                chunk = fp.read(min(skip, slab_read_size))
+                if not chunk:
+                    break
+                skip -= len(chunk)
+            buf = fp.read(nbytes)
+        finally:
+            fp.close()
+        if len(buf) < nbytes:
+            raise IOError('%s is truncated' % self.filename)
+        return self._scale(np.ndarray(shape, dtype, buf, order='F'))
+
+# Bytes of voxel data read at a time when building pyramid levels and
+# intensity tables
+slab_read_size = 16 * 1024 * 1024
+
+def downsample(data):
+    """Halve the first three dimensions of data by averaging blocks of
+    2x2x2 voxels.
+
+    Odd sizes are rounded up, the last voxel along them is averaged
+    with itself.
+
+    """
+
+    data = np.asarray(data, np.float32)
+    for axis in range(3):
+        if data.shape[axis] % 2:
+            last = data.take([data.shape[axis] - 1], axis=axis)
+            data = np.concatenate((data, last), axis=axis)
+    nx, ny, nz = data.shape[:3]
+    blocks = data.reshape((nx // 2, 2, ny // 2, 2, nz // 2, 2) +
+                          data.shape[3:])
+    return blocks.sum(axis=5).sum(axis=3).sum(axis=1) / 8
+
+def fit_level(voxels, pixels, max_level):
+    """Return the pyramid level to show voxels on pixels of screen.
+
+    This is the coarsest level that still has at least one voxel per
+    screen pixel, up to max_level.
+
+    """
+
+    if pixels <= 0:
+        return 0
+    level = 0
+    per_pixel = float(voxels) / pixels
+    while per_pixel >= 2 and level < max_level:
+        per_pixel /= 2
+        level += 1
+    return level
+
+# Planes along the projected axis per block of cached projections
+projection_block = 16
+
+def _finite(data):
+    """Return the values of data that are not NaN or infinite."""
+    data = np.asarray(data)
+    if data.dtype.kind in 'fc':
+        return data[np.isfinite(data)]
+    return data
+
+def _finite_range(data):
+    """Return (min, max) of the finite values of data, None if there
+    are none."""
+    data = _finite(data)
+    if data.size == 0:
+        return None
+    return data.min(), data.max()
+
+class IntensityTable(object):
+    """Histograms of the intensities of a volume, whole and per slab of
+    planes, for picking display windows without reading voxels.
+
+    Parameters
+    ----------
+    low, high : float
+        Range of the intensities.
+    slab_counts : numpy.ndarray
+        (nslabs, nbins) histogram of each slab over the bins that split
+        low to high evenly.
+    slab_starts : list
+        Index along the third voxel axis of the first plane of each
+        slab.
+
+    Attributes
+    ----------
+    edges : numpy.ndarray
+        Bin edges, nbins + 1 of them.
+    counts : numpy.ndarray
+        Histogram of the whole volume.
+
+    """
+
+    def __init__(self, low, high, slab_counts, slab_starts):
+        self.low = float(low)
+        self.high = float(high)
+        self.slab_counts = np.asarray(slab_counts, np.int64)
+        self.slab_starts = list(slab_starts)
+        self.counts = self.slab_counts.sum(axis=0)
+        nbins = self.slab_counts.shape[1]
+        self.edges = np.linspace(self.low, self.high, nbins + 1)
+        # Cumulative counts, the percentile table
+        self._cdf = np.cumsum(self.counts)
+        self._slab_cdf = np.cumsum(self.slab_counts, axis=1)
+
+    def slab(self, plane):
+        """Return the slab that holds plane, along the third voxel
+        axis."""
+        return max(0, bisect.bisect_right(self.slab_starts, plane) - 1)
+
+    def percentile(self, q, slab=None):
+        """Return the intensity below which q percent of the voxels,
+        of the volume or of slab, are.
+
+        Interpolates linearly within the bin the percentile falls in.
+
+        """
+
+        if slab is None:
+            cdf = self._cdf
+        else:
+            cdf = self._slab_cdf[slab]
+        total = cdf[-1]
+        if total == 0:
+            return self.low
+        target = total * min(max(q, 0), 100) / 100.0
+        i = min(np.searchsorted(cdf, target), len(cdf) - 1)
+        below = cdf[i - 1] if i > 0 else 0
+        inside = cdf[i] - below
+        frac = (target - below) / float(inside) if inside else 0.0
+        return self.edges[i] + frac * (self.edges[i + 1] - self.edges[i])
+
+    def window(self, low=2, high=98, slab=None):
+        """Return the (low, high) window between two percentiles."""
+        return self.percentile(low, slab), self.percentile(high, slab)
+
 class Image(object):
+    """A NIfTI or Analyze image, read lazily through a VolumeProxy.
+
+    For 4D images the slice getters return slices of one volume, the
+    timepoint attribute by default.  Use volumes() to go through the
+    volumes of a run without holding them all in memory.
+
+    Downsampled copies of a volume, pyramid levels, are built the first
+    time a slice of them is asked for and kept for that volume.  So are
+    intensity histograms, see intensity_table.
+
+    """
+
     def __init__(self, filename=None):
         self.img = None
         self.filename = filename
+        # Volume the slice getters read by default
+        self.timepoint = 0
         if filename is not None:
             self.load_image(filename)
 
@@ -13,25 +412,475 @@ class Image(object):
         img = pynifti.load(filename)
         self.img = img
         self.filename = filename
-        self.data = self.img.get_data()
+        self.timepoint = 0
+        # Voxel data is only read when slices are asked for
+        self.data = VolumeProxy(filename, img)
+        # Pyramid levels by (level, tindex), all of one volume
+        self._pyramid = {}
+        # Intensity tables by (tindex, nbins)
+        self._tables = {}
+        self._pyramid_lock = threading.Lock()
+        # Block projections by (axis, tindex) and time projections by
+        # kind, built by one thread at a time
+        self._blocks = {}
+        self._time_projections = {}
+        self._build_lock = threading.RLock()
+        self.axes, self.flips = ras_orientation(self.affine)
+        self._plans = dict((name, self._slice_plan(*axes))
+                           for name, axes in slice_axes.iteritems())
+
+    def _slice_plan(self, fixed, rows, cols):
+        """Work out how to read a slice in RAS orientation.
+
+        Returns (axis, flip, transpose, row_step, col_step): the voxel
+        axis to index, whether the index counts from its end, whether
+        the 2D array read needs transposing, and the steps that flip
+        its rows and columns.
+
+        """
+
+        axis = self.axes[fixed]
+        remaining = [ax for ax in range(3) if ax != axis]
+        transpose = remaining[0] != self.axes[rows]
+        row_step = -1 if self.flips[rows] else 1
+        col_step = -1 if self.flips[cols] else 1
+        return axis, self.flips[fixed], transpose, row_step, col_step
+
+    @property
+    def ras_shape(self):
+        """Size of the image along R, A and S, the ranges of the
+        indices taken by the slice getters."""
+        shape = self.shape
+        return tuple(shape[ax] for ax in self.axes)
+
+    @property
+    def max_level(self):
+        """The pyramid level at which the volume is one voxel."""
+        level = 0
+        size = max(self.shape[:3])
+        while size > 1:
+            size = (size + 1) // 2
+            level += 1
+        return level
+
+    def slab_planes(self):
+        """Return the number of planes, along the third voxel axis, read
+        at a time when going through a volume.
+
+        This is an even number, so 2x2x2 blocks are not split.
+
+        """
+
+        shape = self.shape
+        itemsize = 8
+        if self.data.header is not None:
+            itemsize = max(1, self.data.header.bitpix // 8)
+        plane = shape[0] * shape[1] * itemsize
+        return max(2, slab_read_size // plane // 2 * 2)
+
+    def slabs(self, tindex=None):
+        """Read volume tindex, or self.timepoint, a slab of planes at a
+        time.
+
+        Returns
+        -------
+        slabs : generator
+            Yields (start, data) for each slab, start is the index of
+            its first plane along the third voxel axis.
+
+        """
+
+        if tindex is None:
+            tindex = self.timepoint
+        shape = self.shape
+        nplanes = self.slab_planes()
+        for start in xrange(0, shape[2], nplanes):
+            index = [slice(None)] * len(shape)
+            index[2] = slice(start, start + nplanes)
+            if len(shape) > 3:
+                index[3] = tindex
+            yield start, self.data[tuple(index)]
+
+    def _first_level(self, tindex):
+        """Downsample volume tindex, reading it a slab at a time."""
+        shape = self.shape
+        out = np.empty([(size + 1) // 2 for size in shape[:3]], np.float32)
+        for start, slab in self.slabs(tindex):
+            out[:, :, start // 2:start // 2 + (slab.shape[2] + 1) // 2] = \
+                downsample(slab)
+        return out
+
+    def has_level(self, level, tindex=None):
+        """True if pyramid level of volume tindex is built."""
+        if tindex is None:
+            tindex = self.timepoint
+        return level == 0 or (level, tindex) in self._pyramid
+
+    def get_level(self, level, tindex=None):
+        """Return volume tindex, or self.timepoint, downsampled
+        2**level times along each spatial axis, in voxel order.
+
+        Levels are built the first time they are asked for, from the
+        level below, and kept until a level of another volume is
+        built.
+
+        """
+
+        if tindex is None:
+            tindex = self.timepoint
+        if level == 0:
+            return self.get_volume(tindex)
+        key = (level, tindex)
+        with self._pyramid_lock:
+            data = self._pyramid.get(key)
+        if data is None:
+            if level == 1:
+                data = self._first_level(tindex)
+            else:
+                data = downsample(self.get_level(level - 1, tindex))
+            with self._pyramid_lock:
+                for old in [k for k in self._pyramid if k[1] != tindex]:
+                    del self._pyramid[old]
+                self._pyramid[key] = data
+        return data
+
+    def intensity_table(self, tindex=None, nbins=1024):
+        """Return the IntensityTable of volume tindex, or
+        self.timepoint.
+
+        The table is computed the first time it is asked for, with two
+        passes through the volume, and kept.
+
+        """
+
+        if tindex is None:
+            tindex = self.timepoint
+        with self._pyramid_lock:
+            table = self._tables.get((tindex, nbins))
+        if table is None:
+            ranges = []
+            for start, slab in self.slabs(tindex):
+                ranges.append((start, _finite_range(slab)))
+            low = min([r[0] for s, r in ranges if r is not None] or [0])
+            high = max([r[1] for s, r in ranges if r is not None] or [1])
+            starts = [start for start, r in ranges]
+            counts = np.zeros((len(starts), nbins), np.int64)
+            for i, (start, slab) in enumerate(self.slabs(tindex)):
+                counts[i] = np.histogram(_finite(slab), nbins,
+                                         (low, high))[0]
+            table = IntensityTable(low, high, counts, starts)
+            with self._pyramid_lock:
+                self._tables[(tindex, nbins)] = table
+        return table
+
+    def get_slice(self, name, index, tindex=None, step=1, level=0):
+        """Return slice index of volume tindex, with rows and columns
+        in RAS orientation.
+
+        The transpose and flips are views of the data read, so no copy
+        is made beyond the read itself.
+
+        Parameters
+        ----------
+        name : {'axial', 'coronal', 'sagittal'}
+            Orientation of the slice.
+        index : int
+            Index of the slice along its RAS axis.
+        tindex : int
+            Volume of a 4D image, self.timepoint if None.
+        step : int
+            Read only every step'th row and column, for a quick
+            preview.
+        level : int
+            Pyramid level to take the slice from.  index is still in
+            full resolution voxels.
+
+        """
+
+        if tindex is None:
+            tindex = self.timepoint
+        full = self.slice_index(name, index, tindex, step, level)
+        return self.read_slice(name, full, tindex, level)
+
+    def slice_index(self, name, index, tindex=None, step=1, level=0):
+        """Return the index into the data, or into pyramid level, of
+        the slice get_slice returns.
+
+        Images with the same shape and affine have the same index for
+        a slice, so it is worked out once for all of them.
 
-    def get_axial_slice(self, zindex):
-        # XXX implement real slicing.  Assuming xyz ordering.
-        data = self.data[:, :, zindex]
-        # transpose so it's C ordered
-        return data.T
+        """
 
-    def get_coronal_slice(self, yindex):
-        # XXX implement real slicing.  Assuming xyz ordering.
-        data = self.data[:, yindex, :]
-        # transpose so it's C ordered
-        return data.T
+        axis, flip, transpose, row_step, col_step = self._plans[name]
+        if flip:
+            index = self.shape[axis] - 1 - index
+        if tindex is None:
+            tindex = self.timepoint
+        if level > 0:
+            full = [slice(None, None, step)] * 3
+            full[axis] = index >> level
+        else:
+            full = [slice(None, None, step)] * len(self.shape)
+            full[axis] = index
+            if len(full) > 3:
+                full[3] = tindex
+        return tuple(full)
 
-    def get_sagittal_slice(self, xindex):
-        # XXX implement real slicing.  Assuming xyz ordering.
-        data = self.data[xindex, :, :]
-        # transpose so it's C ordered
-        return data.T
+    def read_slice(self, name, full, tindex=None, level=0):
+        """Return the slice at index full, from slice_index, with rows
+        and columns in RAS orientation."""
+        if level > 0:
+            if tindex is None:
+                tindex = self.timepoint
+            volume = self.get_level(level, tindex)
+        else:
+            volume = self.data
+        return self._orient(name, volume[full])
+
+    def _orient(self, name, data):
+        """Return data, 2D in the order of the voxel axes left by a
+        slice name, in RAS orientation as a view."""
+        axis, flip, transpose, row_step, col_step = self._plans[name]
+        if transpose:
+            data = data.T
+        return data[::row_step, ::col_step]
+
+    def volume_slice(self, volume, name, index, step=1):
+        """Return slice index of volume, like get_slice.
+
+        volume is a 3D array in voxel order, of the spatial shape of
+        the image, such as a time_projection.
+
+        """
+
+        axis, flip = self._plans[name][:2]
+        if flip:
+            index = volume.shape[axis] - 1 - index
+        full = [slice(None, None, step)] * 3
+        full[axis] = index
+        return self._orient(name, volume[tuple(full)])
+
+    def _planes(self, axis, start, stop, tindex):
+        """Read planes start to stop along voxel axis of volume
+        tindex."""
+        index = [slice(None)] * len(self.shape)
+        index[axis] = slice(start, stop)
+        if len(index) > 3:
+            index[3] = tindex
+        return self.data[tuple(index)]
+
+    def _projection_blocks(self, axis, tindex):
+        """Return the max and sum projections of each block of
+        projection_block planes along voxel axis, of volume tindex.
+
+        Computed in one pass through the volume, a slab at a time, and
+        kept for one volume.
+
+        Returns
+        -------
+        maxima, sums : numpy.ndarray
+            (nblocks, n, m) arrays, n and m the sizes of the other two
+            voxel axes.
+
+        """
+
+        with self._build_lock:
+            blocks = self._blocks.get((axis, tindex))
+            if blocks is not None:
+                return blocks
+            shape = self.shape[:3]
+            size = projection_block
+            nblocks = (shape[axis] + size - 1) // size
+            other = [shape[ax] for ax in range(3) if ax != axis]
+            maxima = np.empty([nblocks] + other, np.float32)
+            maxima.fill(-np.inf)
+            sums = np.zeros([nblocks] + other, np.float64)
+            for start, slab in self.slabs(tindex):
+                slab = np.asarray(slab, np.float32)
+                if axis == 2:
+                    # The slab holds parts of whole planes of blocks
+                    first = (size - start % size) % size
+                    edges = sorted(set([0] + range(first, slab.shape[2],
+                                                   size)))
+                    slab_max = np.fmax.reduceat(slab, edges, axis=2)
+                    slab_sum = np.add.reduceat(slab, edges, axis=2)
+                    for i, edge in enumerate(edges):
+                        block = (start + edge) // size
+                        np.fmax(maxima[block], slab_max[:, :, i],
+                                out=maxima[block])
+                        sums[block] += slab_sum[:, :, i]
+                else:
+                    # The slab holds a range of planes of every block
+                    edges = range(0, shape[axis], size)
+                    stop = start + slab.shape[2]
+                    maxima[:, :, start:stop] = np.rollaxis(
+                        np.fmax.reduceat(slab, edges, axis=axis), axis)
+                    sums[:, :, start:stop] = np.rollaxis(
+                        np.add.reduceat(slab, edges, axis=axis), axis)
+            blocks = maxima, sums
+            for old in [k for k in self._blocks if k[1] != tindex]:
+                del self._blocks[old]
+            self._blocks[(axis, tindex)] = blocks
+        return blocks
+
+    def projection(self, name, kind='max', start=0, stop=None, tindex=None):
+        """Return the maximum or mean intensity projection through a
+        slab of slices.
+
+        The first projection along an axis reads the volume once to
+        project blocks of projection_block planes.  After that a slab
+        is projected from the cached blocks it covers, reading only
+        the planes at its ends that are not in whole blocks.
+
+        Parameters
+        ----------
+        name : {'axial', 'coronal', 'sagittal'}
+            Slices to project through, the result is oriented like one.
+        kind : {'max', 'mean'}
+            Projection to compute.
+        start, stop : int
+            Range of slice indices of the slab, all slices by default.
+        tindex : int
+            Volume of a 4D image, self.timepoint if None.
+
+        Returns
+        -------
+        proj : numpy.ndarray
+            float32 projection.
+
+        """
+
+        if kind not in ('max', 'mean'):
+            raise ValueError("Unknown projection '%s'" % kind)
+        if tindex is None:
+            tindex = self.timepoint
+        axis, flip = self._plans[name][:2]
+        nplanes = self.shape[axis]
+        start = max(0, start)
+        if stop is None or stop > nplanes:
+            stop = nplanes
+        if start >= stop:
+            raise ValueError('Empty slab %d:%d' % (start, stop))
+        if flip:
+            start, stop = nplanes - stop, nplanes - start
+        maxima, sums = self._projection_blocks(axis, tindex)
+        size = projection_block
+        # Whole blocks in the slab, the last block may be short
+        first = (start + size - 1) // size
+        last = len(maxima) if stop == nplanes else stop // size
+        parts = []
+        total = 0
+        if first < last:
+            parts.append(np.fmax.reduce(maxima[first:last], axis=0))
+            total = sums[first:last].sum(axis=0)
+            ends = [(start, first * size), (min(last * size, stop), stop)]
+        else:
+            ends = [(start, stop)]
+        for end_start, end_stop in ends:
+            if end_start < end_stop:
+                data = np.asarray(self._planes(axis, end_start, end_stop,
+                                               tindex), np.float32)
+                parts.append(np.fmax.reduce(data, axis=axis))
+                total = total + data.sum(axis=axis, dtype=np.float64)
+        if kind == 'max':
+            proj = np.fmax.reduce(parts, axis=0)
+        else:
+            proj = (total / (stop - start)).astype(np.float32)
+        return self._orient(name, proj)
+
+    def time_projection(self, kind='max'):
+        """Return the maximum or mean over time of the volumes, a 3D
+        float32 array in voxel order.  Computed once, a volume at a
+        time, and kept."""
+        if kind not in ('max', 'mean'):
+            raise ValueError("Unknown projection '%s'" % kind)
+        with self._build_lock:
+            proj = self._time_projections.get(kind)
+            if proj is not None:
+                return proj
+            for tindex, volume in self.volumes():
+                if proj is None:
+                    proj = np.array(volume, np.float32)
+                elif kind == 'max':
+                    np.fmax(proj, volume, out=proj)
+                else:
+                    proj += volume
+            if kind == 'mean':
+                proj /= self.ntimepoints
+            self._time_projections[kind] = proj
+        return proj
+
+    def get_axial_slice(self, zindex, tindex=None):
+        """Return axial slice zindex, anterior up and right to the
+        right, indexed from inferior."""
+        return self.get_slice('axial', zindex, tindex)
+
+    def get_coronal_slice(self, yindex, tindex=None):
+        """Return coronal slice yindex, superior up and right to the
+        right, indexed from posterior."""
+        return self.get_slice('coronal', yindex, tindex)
+
+    def get_sagittal_slice(self, xindex, tindex=None):
+        """Return sagittal slice xindex, superior up and anterior to
+        the right, indexed from left."""
+        return self.get_slice('sagittal', xindex, tindex)
+
+    def get_volume(self, tindex=None):
+        """Return volume tindex, or self.timepoint if tindex is None."""
+        if len(self.shape) < 4:
+            return self.data[...]
+        if tindex is None:
+            tindex = self.timepoint
+        return self.data[:, :, :, tindex]
+
+    def volumes(self, slab=1, start=0, stop=None):
+        """Read the volumes of the image one slab at a time.
+
+        Volumes are contiguous in the file, so each slab is a single
+        read and only one slab is in memory at a time.
+
+        Parameters
+        ----------
+        slab : int
+            Number of volumes read at a time.
+        start, stop : int
+            Range of volumes to read, all volumes by default.
+
+        Returns
+        -------
+        volumes : generator
+            Yields (tindex, data) for each slab.  tindex is the first
+            volume of the slab.  data is the 3D volume if slab is 1,
+            else a 4D array of up to slab volumes.
+
+        Examples
+        --------
+        Mean of each volume of a run::
+
+            means = [vol.mean() for t, vol in img.volumes()]
+
+        """
+
+        if stop is None:
+            stop = self.ntimepoints
+        if len(self.shape) < 4:
+            if start < stop:
+                yield 0, self.data[...]
+            return
+        for tindex in xrange(start, stop, slab):
+            if slab == 1:
+                yield tindex, self.data[:, :, :, tindex]
+            else:
+                end = min(tindex + slab, stop)
+                yield tindex, self.data[:, :, :, tindex:end]
+
+    @property
+    def ntimepoints(self):
+        """Number of volumes, 1 for a 3D image."""
+        shape = self.shape
+        if len(shape) < 4:
+            return 1
+        return shape[3]
 
     @property
     def shape(self):
@@ -40,5 +889,3 @@ class Image(object):
     @property
     def affine(self):
         return self.img.get_affine()
-
-
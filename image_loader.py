@@ -0,0 +1,120 @@
+"""Load images for the slice viewer on a worker thread.
+
+An ImageLoader opens an image and reads the slices through the voxel
+at its center on a thread of its own, so the viewer stays responsive
+while a large or gzipped image is read.  It reports back in stages:
+
+preview
+    (img, slices): the opened Image and the three center slices read
+    with a stride, scaled back up to full size, for display while the
+    full slices are read.
+ready
+    cache: a slice_cache.SliceCache of the image, holding the three
+    full resolution center slices.
+error
+    The exception raised while loading.
+
+"""
+
+import threading
+
+import numpy as np
+
+from image import Image, slice_axes
+from slice_cache import SliceCache
+
+# Largest side of a preview slice, in voxels
+preview_size = 64
+
+def center_voxel(img):
+    """Return the index of the center slice of img along R, A and S."""
+    return [size // 2 for size in img.ras_shape]
+
+def upsample(data, step, shape):
+    """Return data repeated step times along both axes, cut to shape."""
+    if step == 1:
+        return data
+    data = np.repeat(np.repeat(data, step, axis=0), step, axis=1)
+    return data[:shape[0], :shape[1]]
+
+class LoadCancelled(Exception):
+    """The load was cancelled."""
+    pass
+
+class ImageLoader(object):
+    """Load the image filename on a worker thread.
+
+    Parameters
+    ----------
+    filename : string
+        The image to load.
+    callback : callable
+        Called as callback(loader, stage, value) for each stage, on the
+        worker thread.  GUI code must pass the call on to its own
+        thread.
+
+    """
+
+    def __init__(self, filename, callback):
+        self.filename = filename
+        self.callback = callback
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='ImageLoader %s' % filename)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        """Stop loading.  No stage is reported after cancel returns,
+        though the read in progress runs to completion."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _report(self, stage, value):
+        if self.cancelled:
+            raise LoadCancelled()
+        self.callback(self, stage, value)
+
+    def _read_slices(self, img, step=1):
+        """Return the slices through the center voxel of img."""
+        center = center_voxel(img)
+        slices = {}
+        for name, axes in slice_axes.iteritems():
+            if self.cancelled:
+                raise LoadCancelled()
+            slices[name] = img.get_slice(name, center[axes[0]], 0, step)
+        return slices
+
+    def _run(self):
+        try:
+            img = Image(self.filename)
+            if self.cancelled:
+                raise LoadCancelled()
+            step = max(1, max(img.ras_shape) // preview_size)
+            if step > 1:
+                shape = img.ras_shape
+                slices = self._read_slices(img, step)
+                for name, (fixed, rows, cols) in slice_axes.iteritems():
+                    slices[name] = upsample(slices[name], step,
+                                            (shape[rows], shape[cols]))
+                self._report('preview', (img, slices))
+            cache = SliceCache(img)
+            center = center_voxel(img)
+            for name, axes in slice_axes.iteritems():
+                if self.cancelled:
+                    raise LoadCancelled()
+                cache.get(name, center[axes[0]], 0)
+            self._report('ready', cache)
+        except LoadCancelled:
+            pass
+        except Exception, err:
+            if not self.cancelled:
+                self.callback(self, 'error', err)
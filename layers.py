@@ -0,0 +1,255 @@
+"""Images drawn over each other in the slice viewer.
+
+A LayerStack holds overlays, such as a statistical map or the same
+subject before preprocessing, on the grid of a base image.  The slices
+through the cursor of all overlays are read together: overlays with the
+same voxel grid share the index of each slice, worked out once, and
+each keeps its own SliceCache.  A Blender alpha blends the colored
+overlay slices onto the colored base slice into arrays it reuses from
+one slice to the next.
+
+Overlays are not resampled, so they must cover the same voxels as the
+base image, though they may be stored in another orientation.
+
+Only numpy is needed, so layers can be rendered without a GUI.
+
+"""
+
+import numpy as np
+
+from colormaps import Colorizer, get_lut
+from slice_cache import SliceCache
+
+def ras_affine(img):
+    """Return the voxel to world transform of img for indices along
+    R, A and S, the indices the slice getters take."""
+    shape = img.shape
+    permute = np.zeros((4, 4))
+    for ras, vox in enumerate(img.axes):
+        if img.flips[ras]:
+            permute[vox, ras] = -1
+            permute[vox, 3] = shape[vox] - 1
+        else:
+            permute[vox, ras] = 1
+    permute[3, 3] = 1
+    return np.dot(np.asarray(img.affine, np.float64), permute)
+
+def grid_key(img):
+    """Return a key that is the same for images with the same voxel
+    grid, so the same slice index reads the same slice of each."""
+    affine = np.round(np.asarray(img.affine, np.float64), 4)
+    return tuple(img.shape[:3]), tuple(affine.ravel())
+
+class Layer(object):
+    """An image drawn over the base image.
+
+    Parameters
+    ----------
+    img : image.Image
+        The overlay image.
+    cmap : string
+        Name of its colormap, see colormaps.segments.
+    alpha : float
+        Opacity, from 0 to 1.
+    window : tuple
+        (low, high) values mapped to the ends of the colormap, or None
+        to use the range of each slice.
+    threshold : float
+        Voxels below threshold are not drawn, None to draw them all.
+
+    """
+
+    def __init__(self, img, cmap='hot', alpha=0.5, window=None,
+                 threshold=None):
+        self.img = img
+        self.cache = SliceCache(img)
+        self.cmap = cmap
+        self.lut = get_lut(cmap)
+        self.alpha = alpha
+        self.window = window
+        self.threshold = threshold
+        self.visible = True
+        self.grid = grid_key(img)
+        # Colorizers by slice name, as each reuses arrays of its shape
+        self._colorizers = {}
+
+    def colorizer(self, name):
+        """Return the Colorizer of the slices called name."""
+        colorizer = self._colorizers.get(name)
+        if colorizer is None:
+            colorizer = Colorizer(self.lut, self.window)
+            self._colorizers[name] = colorizer
+        return colorizer
+
+    def set_colormap(self, cmap):
+        self.cmap = cmap
+        self.lut = get_lut(cmap)
+        for colorizer in self._colorizers.itervalues():
+            colorizer.set_lut(self.lut)
+
+    def set_window(self, window):
+        self.window = window
+        for colorizer in self._colorizers.itervalues():
+            colorizer.set_window(window)
+
+    def timepoint(self, tindex):
+        """Return the volume shown with volume tindex of the base
+        image, the last one for images with fewer volumes."""
+        return min(tindex, self.img.ntimepoints - 1)
+
+    def close(self):
+        self.cache.close()
+
+class LayerStack(object):
+    """Overlays on the grid of a base image, bottom one first.
+
+    Parameters
+    ----------
+    base : image.Image
+        The image the overlays are drawn on.
+
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.layers = []
+        self._affine = ras_affine(base)
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def check(self, img):
+        """Raise ValueError if img does not cover the voxels of the
+        base image."""
+        if img.ras_shape != self.base.ras_shape or \
+                not np.allclose(ras_affine(img), self._affine, atol=1e-3):
+            raise ValueError("Overlay %s is not on the grid of %s" %
+                             (img.filename, self.base.filename))
+
+    def add(self, layer):
+        """Put layer on top, see check."""
+        self.check(layer.img)
+        self.layers.append(layer)
+
+    def remove(self, layer):
+        self.layers.remove(layer)
+        layer.close()
+
+    def clear(self):
+        for layer in self.layers:
+            layer.close()
+        self.layers = []
+
+    def read(self, name, index, tindex, level=0):
+        """Return the slices of the visible overlays through a cursor.
+
+        Slices not in the cache of their layer are read, with the
+        slice index worked out once for each grid.
+
+        Parameters
+        ----------
+        name : {'axial', 'coronal', 'sagittal'}
+            Orientation of the slices.
+        index : int
+            Index of the slices along their RAS axis.
+        tindex : int
+            Volume of the base image shown.
+        level : int
+            Pyramid level to take the slices from.
+
+        Returns
+        -------
+        slices : list
+            (layer, data) for each visible layer, bottom one first.
+
+        """
+
+        slices = []
+        indices = {}
+        for layer in self.layers:
+            if not layer.visible:
+                continue
+            t = layer.timepoint(tindex)
+            key = (name, index, t, level)
+            data = layer.cache.lookup(key)
+            if data is None:
+                grid = (layer.grid, t)
+                full = indices.get(grid)
+                if full is None:
+                    full = layer.img.slice_index(name, index, t,
+                                                 level=level)
+                    indices[grid] = full
+                # Copied out of any memmap, as SliceCache does
+                data = np.array(layer.img.read_slice(name, full, t, level),
+                                order='C')
+                layer.cache.put(key, data)
+            slices.append((layer, data))
+        return slices
+
+    def prefetch(self, keys):
+        """Read the slices keys, as for SliceCache.prefetch, of every
+        visible layer in the background."""
+        for layer in self.layers:
+            if layer.visible:
+                layer.cache.prefetch([(name, index, layer.timepoint(t), level)
+                                      for name, index, t, level in keys])
+
+class Blender(object):
+    """Alpha blend overlays onto a base slice into reused arrays.
+
+    Like Colorizer, the RGBA array returned is the same object until
+    the shape of the slices changes.
+
+    """
+
+    def __init__(self):
+        self._color = None
+        self._scratch = None
+        self._alpha = None
+        self._mask = None
+        self._rgba = None
+
+    def _buffers(self, shape):
+        """Make sure the arrays are of the slice shape."""
+        if self._rgba is None or self._rgba.shape[:2] != shape:
+            self._color = np.empty(shape + (3,), np.float32)
+            self._scratch = np.empty(shape + (3,), np.float32)
+            self._alpha = np.empty(shape, np.float32)
+            self._mask = np.empty(shape, np.bool_)
+            self._rgba = np.empty(shape + (4,), np.uint8)
+
+    def __call__(self, base, overlays):
+        """Return the RGBA colors of overlays blended onto base.
+
+        Parameters
+        ----------
+        base : numpy.ndarray
+            (rows, cols, 4) uint8 RGBA colors of the base slice.
+        overlays : list
+            (rgba, alpha, data, threshold) for each overlay, bottom one
+            first: its RGBA colors, opacity, the slice data and the
+            value below which it is not drawn, or None.
+
+        """
+
+        shape = base.shape[:2]
+        self._buffers(shape)
+        color = self._color
+        scratch = self._scratch
+        alpha = self._alpha
+        color[...] = base[..., :3]
+        for rgba, opacity, data, threshold in overlays:
+            np.multiply(rgba[..., 3], opacity / 255.0, out=alpha)
+            if threshold is not None:
+                np.greater_equal(data, threshold, out=self._mask)
+                alpha *= self._mask
+            # color += alpha * (overlay - color)
+            np.subtract(rgba[..., :3], color, out=scratch)
+            scratch *= alpha[..., np.newaxis]
+            color += scratch
+        self._rgba[..., :3] = color
+        self._rgba[..., 3] = base[..., 3]
+        return self._rgba
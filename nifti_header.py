@@ -0,0 +1,177 @@
+"""Read the header of NIfTI-1 and Analyze 7.5 images.
+
+Only the 348 byte header is read, never the voxel data.  For gzipped
+files only as much of the file is decompressed as is needed to get
+the header.  No image library is needed.
+
+"""
+
+import os
+import gzip
+import struct
+
+# Size of a NIfTI-1 or Analyze header in bytes
+header_size = 348
+
+# NIfTI-1 datatype codes: (name, numpy dtype or None if there is no
+# matching numpy dtype).  Analyze 7.5 uses the same codes.
+datatypes = {
+    1: ('binary', None),
+    2: ('uint8', 'u1'),
+    4: ('int16', 'i2'),
+    8: ('int32', 'i4'),
+    16: ('float32', 'f4'),
+    32: ('complex64', 'c8'),
+    64: ('float64', 'f8'),
+    128: ('rgb24', None),
+    256: ('int8', 'i1'),
+    512: ('uint16', 'u2'),
+    768: ('uint32', 'u4'),
+    1024: ('int64', 'i8'),
+    1280: ('uint64', 'u8'),
+    1536: ('float128', 'f16'),
+    1792: ('complex128', 'c16'),
+    2048: ('complex256', 'c32'),
+    2304: ('rgba32', None),
+    }
+
+class HeaderError(Exception):
+    """The file is not a NIfTI-1 or Analyze image."""
+    pass
+
+class NiftiHeader(object):
+    """The fields of a NIfTI-1 or Analyze header needed to find and
+    describe the voxel data.
+
+    Attributes
+    ----------
+    endian : {'<', '>'}
+        Byte order of the header and the voxel data.
+    dim : tuple
+        Size of each used dimension, (x, y, z, t, ...).
+    datatype : int
+        Datatype code, see datatypes.
+    bitpix : int
+        Bits per voxel.
+    pixdim : tuple
+        Voxel size of each used dimension.
+    vox_offset : int
+        Byte offset of the voxel data in the data file.
+    scl_slope, scl_inter : float
+        Scaling of the stored values, 0 slope means no scaling.
+    magic : string
+        'n+1' for single file NIfTI, 'ni1' for a NIfTI header/image
+        pair, '' for Analyze.
+
+    """
+
+    def __init__(self, data):
+        if len(data) < header_size:
+            raise HeaderError('Header is %d bytes, expected %d'
+                              % (len(data), header_size))
+        for endian in '<>':
+            if struct.unpack(endian + 'i', data[:4])[0] == header_size:
+                break
+        else:
+            raise HeaderError('Not a NIfTI-1 or Analyze header')
+        self.endian = endian
+        dim = struct.unpack(endian + '8h', data[40:56])
+        ndim = dim[0]
+        if not 0 < ndim <= 7:
+            raise HeaderError('Invalid number of dimensions %d' % ndim)
+        self.dim = dim[1:ndim + 1]
+        self.datatype, self.bitpix = struct.unpack(endian + '2h', data[70:74])
+        self.pixdim = struct.unpack(endian + '8f', data[76:108])[1:ndim + 1]
+        vox_offset, self.scl_slope, self.scl_inter = \
+            struct.unpack(endian + '3f', data[108:120])
+        self.vox_offset = int(vox_offset)
+        self.magic = data[344:348].rstrip('\0')
+        if self.magic not in ('n+1', 'ni1'):
+            self.magic = ''
+
+    @property
+    def is_nifti(self):
+        return self.magic != ''
+
+    @property
+    def shape(self):
+        return self.dim
+
+    @property
+    def ntimepoints(self):
+        """Number of volumes, 1 for a 3D image."""
+        if len(self.dim) < 4:
+            return 1
+        return self.dim[3]
+
+    @property
+    def nvoxels(self):
+        nvox = 1
+        for size in self.dim:
+            nvox *= size
+        return nvox
+
+    @property
+    def data_nbytes(self):
+        """Size of the voxel data in bytes, uncompressed."""
+        return self.nvoxels * self.bitpix // 8
+
+    @property
+    def datatype_name(self):
+        return datatypes.get(self.datatype, ('unknown', None))[0]
+
+    @property
+    def dtype(self):
+        """numpy dtype string of the voxel data, None if numpy has no
+        matching dtype."""
+        code = datatypes.get(self.datatype, (None, None))[1]
+        if code is None:
+            return None
+        if code[1:] == '1':
+            return code
+        return self.endian + code
+
+def _open(filename):
+    """Open filename for reading, decompressing it if it is gzipped."""
+    if filename.endswith('.gz'):
+        return gzip.GzipFile(filename, 'rb')
+    return open(filename, 'rb')
+
+def header_filename(filename):
+    """Return the file that holds the header of the image filename.
+
+    A .nii file holds its own header.  The header of a .img file is in
+    the .hdr file next to it.
+
+    """
+
+    base = filename
+    gz = ''
+    if base.endswith('.gz'):
+        base, gz = base[:-3], '.gz'
+    if base.endswith('.img'):
+        hdr = base[:-4] + '.hdr'
+        for candidate in (hdr + gz, hdr, hdr + '.gz'):
+            if os.path.exists(candidate):
+                return candidate
+        return hdr + gz
+    return filename
+
+def read_header(filename):
+    """Read the header of the NIfTI-1 or Analyze image filename.
+
+    Raises
+    ------
+    HeaderError
+        If the file does not have a valid header.
+    IOError
+        If the file cannot be read.
+
+    """
+
+    fp = _open(header_filename(filename))
+    try:
+        data = fp.read(header_size)
+    finally:
+        fp.close()
+    return NiftiHeader(data)
@@ -0,0 +1,181 @@
+"""Cache of image slices for the slice viewer.
+
+Reading a slice of a gzipped or otherwise lazily read image can take
+long enough to stall the viewer while the cursor is dragged.  A
+SliceCache keeps recently shown slices, up to a budget of bytes, and
+reads the slices the cursor is moving towards on a background thread
+so they are ready when it gets there.
+
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from image import slice_axes
+
+# Default bytes of slice data kept in a cache
+default_max_bytes = 64 * 1024 * 1024
+
+# Default number of slices read ahead of the cursor
+default_prefetch = 8
+
+class SliceCache(object):
+    """Least recently used cache of the slices of an image.
+
+    Slices are keyed by (name, index, tindex, level), the arguments of
+    Image.get_slice.  name is 'axial', 'coronal' or 'sagittal', level
+    is the pyramid level.
+
+    Parameters
+    ----------
+    img : image.Image
+        The image to read slices from.
+    max_bytes : int
+        The least recently used slices are dropped when the slices in
+        the cache take more than this many bytes.
+    prefetch : int
+        Number of slices prefetch_ahead reads ahead of the cursor.
+
+    """
+
+    def __init__(self, img, max_bytes=default_max_bytes,
+                 prefetch=default_prefetch):
+        self.img = img
+        self.max_bytes = max_bytes
+        self.prefetch_count = prefetch
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._slices = OrderedDict()
+        self._lock = threading.Lock()
+        # Keys waiting for the prefetch thread, replaced by each new
+        # request so it never works on stale ones.
+        self._pending = None
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._slices)
+
+    def __contains__(self, key):
+        return key in self._slices
+
+    def _read(self, key):
+        name, index, tindex, level = key
+        data = self.img.get_slice(name, index, tindex, level=level)
+        # Slices of uncompressed images are views of a memmap.  Copy
+        # them, so the file is read here, on the prefetch thread, and
+        # nbytes is the memory the cache holds.
+        return np.array(data, order='C')
+
+    def put(self, key, data):
+        """Put data in the cache, dropping the least recently used
+        slices to stay within max_bytes."""
+        with self._lock:
+            if key in self._slices or data.nbytes > self.max_bytes:
+                return
+            self._slices[key] = data
+            self.nbytes += data.nbytes
+            while self.nbytes > self.max_bytes:
+                old_key, old = self._slices.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def get(self, name, index, tindex=0, level=0):
+        """Return slice index of volume tindex at pyramid level,
+        reading it if it is not in the cache."""
+        key = (name, index, tindex, level)
+        data = self.lookup(key)
+        if data is None:
+            data = self._read(key)
+            self.put(key, data)
+        return data
+
+    def lookup(self, key):
+        """Return the slice key if it is in the cache, else None."""
+        with self._lock:
+            data = self._slices.pop(key, None)
+            if data is not None:
+                # Move to the most recently used end
+                self._slices[key] = data
+                self.hits += 1
+                return data
+            self.misses += 1
+            return None
+
+    def ahead(self, name, index, tindex, step, time=False, level=0):
+        """Return the keys of the prefetch_count slices after
+        (name, index, tindex, level) in the direction of step, along
+        the slice axis, or along time if time is True."""
+        if time:
+            size = self.img.ntimepoints
+            start = tindex
+        else:
+            size = self.img.ras_shape[slice_axes[name][0]]
+            start = index
+        keys = []
+        for i in range(1, self.prefetch_count + 1):
+            pos = start + i * step
+            if not 0 <= pos < size:
+                break
+            if time:
+                keys.append((name, index, pos, level))
+            else:
+                keys.append((name, pos, tindex, level))
+        return keys
+
+    def prefetch(self, keys):
+        """Read the slices keys on the background thread.
+
+        Keys still waiting from an earlier call are dropped.
+
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+            self._pending = list(keys)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._prefetch_loop,
+                                                name='SliceCache prefetch')
+                self._thread.daemon = True
+                self._thread.start()
+            self._wakeup.notify()
+
+    def prefetch_ahead(self, name, index, tindex, step, time=False,
+                       level=0):
+        """Prefetch the slices the cursor is moving towards, see
+        ahead."""
+        self.prefetch(self.ahead(name, index, tindex, step, time, level))
+
+    def _prefetch_loop(self):
+        while True:
+            with self._lock:
+                while self._pending is None and not self._closed:
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+                keys = self._pending
+                self._pending = None
+            for key in keys:
+                if self._pending is not None or self._closed:
+                    # A newer request came in
+                    break
+                if key not in self._slices:
+                    self.put(key, self._read(key))
+
+    def clear(self):
+        """Drop all slices from the cache."""
+        with self._lock:
+            self._slices.clear()
+            self.nbytes = 0
+
+    def close(self):
+        """Stop the prefetch thread and drop the cached slices."""
+        with self._lock:
+            self._closed = True
+            self._pending = None
+            self._wakeup.notify()
+        self.clear()
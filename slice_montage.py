@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""Render montages of image slices to PNG files, without a GUI.
+
+For quality checks of many scans.  Each image found under the search
+paths gets a PNG with a row of axial, a row of coronal and a row of
+sagittal slices, evenly spaced through the volume, drawn as in the
+slice viewer: anterior or superior up, right to the right.
+
+Slices are read through image.Image, so only the planes a montage shows
+are read, and with a stride for large images.  Gzipped images are
+decompressed once, in one pass without a gzip index, as their coronal
+and sagittal slices each need most of the file.  The intensity window is taken from the slices read, not
+from the whole volume.  Images are rendered in parallel by a pool of
+processes.
+
+For usage, see command-line help:
+    $ ./slice_montage.py -h
+
+Examples
+--------
+
+Render all Nifti images under ~/data into ~/qa, mirroring the
+directories, with 8 processes:
+    ./slice_montage.py -j 8 -o ~/qa ~/data
+
+Render 8 slices per row at most 96 pixels a side, with the hot
+colormap, of the second volume of each 4D image:
+    ./slice_montage.py -n 8 -s 96 -c hot -t 1 -o ~/qa ~/data
+
+Render again only the images changed since the last run, which is the
+default, or all of them:
+    ./slice_montage.py --force -o ~/qa ~/data
+
+"""
+
+import os
+import sys
+import struct
+import zlib
+
+# multiprocessing is only available for Python 2.6 and later.  Without
+# it images are rendered serially.
+try:
+    from multiprocessing import Pool
+except ImportError:
+    Pool = None
+
+import numpy as np
+
+import argparse
+
+from file_stats import all_dirs, _clean_file_list, _clean_skip_dirs
+from image import Image, slice_axes, fit_level
+from colormaps import Colorizer, get_lut, segments
+
+# Rows of a montage, top to bottom
+montage_slices = ('axial', 'coronal', 'sagittal')
+
+# Extensions removed from the names of the images to name the PNGs
+image_extensions = ('.nii.gz', '.nii', '.hdr', '.img.gz', '.img')
+
+def write_png(filename, rgb):
+    """Write the (rows, cols, 3) uint8 array rgb as a PNG image, with
+    zlib and without needing an image library."""
+    rgb = np.ascontiguousarray(rgb, np.uint8)
+    rows, cols = rgb.shape[:2]
+    # Each row starts with filter type 0, no filtering
+    raw = np.zeros((rows, cols * 3 + 1), np.uint8)
+    raw[:, 1:] = rgb.reshape(rows, cols * 3)
+
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', crc)
+
+    header = struct.pack('>IIBBBBB', cols, rows, 8, 2, 0, 0, 0)
+    fp = open(filename, 'wb')
+    try:
+        fp.write('\x89PNG\r\n\x1a\n')
+        fp.write(chunk('IHDR', header))
+        fp.write(chunk('IDAT', zlib.compress(raw.tostring(), 6)))
+        fp.write(chunk('IEND', ''))
+    finally:
+        fp.close()
+
+def slice_positions(size, count):
+    """Return count slice indices evenly spaced through size slices,
+    leaving out the ends, fewer if there are fewer slices."""
+    count = min(count, size)
+    return [int((i + 1) * size // (count + 1)) for i in range(count)]
+
+def read_slices(img, count, size, tindex=0):
+    """Read the slices of the montage of img.
+
+    Parameters
+    ----------
+    img : image.Image
+        The image.
+    count : int
+        Number of slices in each orientation.
+    size : int
+        Largest side of a slice in pixels.  Slices are read every
+        2**level voxels, with the level from image.fit_level.
+    tindex : int
+        Volume of a 4D image.
+
+    Returns
+    -------
+    slices : dict
+        List of 2D arrays for each name in montage_slices.
+
+    """
+
+    if not 0 <= tindex < img.ntimepoints:
+        raise IndexError('Volume %d out of range, image has %d' %
+                         (tindex, img.ntimepoints))
+    shape = img.ras_shape
+    step = 1 << fit_level(max(shape), size, img.max_level)
+    if img.data.is_gzip_indexed:
+        # Each coronal or sagittal slice of a gzipped image decompresses
+        # most of the file, so decompress the volume once instead.  The
+        # gzip index would take another pass to build, for one read.
+        volume = img.data.stream_volume(tindex)
+        def read(name, index):
+            return img.volume_slice(volume, name, index, step)
+    else:
+        def read(name, index):
+            return img.get_slice(name, index, tindex, step)
+    slices = {}
+    for name in montage_slices:
+        fixed = slice_axes[name][0]
+        slices[name] = [read(name, index)
+                        for index in slice_positions(shape[fixed], count)]
+    return slices
+
+def montage_window(slices, low=2.0, high=98.0):
+    """Return the (low, high) percentiles of the finite values of all
+    slices, the window the montage is drawn with."""
+    values = np.concatenate([np.ravel(data) for row in slices.itervalues()
+                             for data in row])
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return 0.0, 1.0
+    return tuple(np.percentile(values, [low, high]))
+
+def render_montage(slices, lut, window, gap=2):
+    """Return the montage of slices as a (rows, cols, 3) uint8 array.
+
+    Each slice is centered in a square cell as large as the largest
+    slice, with gap pixels of black between cells.
+
+    """
+
+    colorizer = Colorizer(lut, window)
+    cell = max(max(data.shape) for row in slices.itervalues()
+               for data in row)
+    ncols = max(len(row) for row in slices.itervalues())
+    nrows = len(montage_slices)
+    out = np.zeros((nrows * (cell + gap) + gap, ncols * (cell + gap) + gap,
+                    3), np.uint8)
+    for i, name in enumerate(montage_slices):
+        for j, data in enumerate(slices[name]):
+            rows, cols = data.shape
+            top = gap + i * (cell + gap) + (cell - rows) // 2
+            left = gap + j * (cell + gap) + (cell - cols) // 2
+            # Slice rows run up the screen, PNG rows down it
+            rgba = colorizer(data)[::-1]
+            out[top:top + rows, left:left + cols] = rgba[..., :3]
+    return out
+
+def montage_filename(filename, root, outdir):
+    """Return the PNG of filename, found under root, in the same
+    directory below outdir."""
+    relpath = os.path.relpath(filename, root)
+    for ext in image_extensions:
+        if relpath.endswith(ext):
+            relpath = relpath[:-len(ext)]
+            break
+    return os.path.join(outdir, relpath + '.png')
+
+def is_current(filename, output):
+    """Whether output was written after filename was last changed."""
+    try:
+        return os.path.getmtime(output) >= os.path.getmtime(filename)
+    except OSError:
+        return False
+
+def make_montage(filename, output, count=6, size=128, cmap='gray',
+                 tindex=0):
+    """Render the montage of the image filename to the PNG output,
+    making its directory if needed."""
+    img = Image(filename)
+    slices = read_slices(img, count, size, tindex)
+    rgb = render_montage(slices, get_lut(cmap), montage_window(slices))
+    dirname = os.path.dirname(output)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Made by another process meanwhile
+            if not os.path.isdir(dirname):
+                raise
+    write_png(output, rgb)
+
+def _make_montage_job(job):
+    """Call make_montage on a pool process.  Returns (filename, error),
+    error is None if the montage was written."""
+    filename, output, options = job
+    try:
+        make_montage(filename, output, **options)
+    except Exception, err:
+        return filename, '%s: %s' % (err.__class__.__name__, err)
+    return filename, None
+
+def find_jobs(paths, outdir, patterns, skip_dirs='', exclude='',
+              force=False):
+    """Generate (filename, output) for the images under paths whose
+    montage is missing or older than the image, all if force."""
+    for root in paths:
+        if os.path.isfile(root):
+            files = [root]
+            root = os.path.dirname(root)
+        else:
+            files = all_dirs(root, patterns, skip_dirs, exclude=exclude)
+        for filename in files:
+            output = montage_filename(filename, root, outdir)
+            if force or not is_current(filename, output):
+                yield filename, output
+
+def render_all(jobs, options, processes=1):
+    """Render the montages of jobs, (filename, output) pairs, with
+    make_montage options.
+
+    Returns
+    -------
+    done, failed : int
+        Number of montages written and of images that failed, which
+        are reported on stderr.
+
+    """
+
+    pool = None
+    map_func = map
+    if processes > 1 and Pool is not None:
+        pool = Pool(processes)
+        map_func = pool.imap_unordered
+    done = failed = 0
+    try:
+        work = ((filename, output, options) for filename, output in jobs)
+        for filename, error in map_func(_make_montage_job, work):
+            if error is None:
+                done += 1
+            else:
+                failed += 1
+                print >> sys.stderr, 'Unable to render %s: %s' % (filename,
+                                                                 error)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return done, failed
+
+def main(argv=None):
+    desc = 'Render montages of image slices to PNG files.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('path', nargs='+',
+                        help='Images, or directories to search for images')
+    parser.add_argument('-o', '--output', default='.', metavar='DIR',
+                        help='Directory to write the PNGs to [.]')
+    parser.add_argument('-p', '--patterns', default='*.nii;*.nii.gz;*.hdr',
+                        help='Filename patterns to search for '
+                        '[*.nii;*.nii.gz;*.hdr]')
+    parser.add_argument('-x', '--exclude', default='',
+                        help='Filename patterns of files to leave out, '
+                        'separated by semicolon')
+    parser.add_argument('-d', '--skip-dirs', nargs='*', default='',
+                        help='Directories to skip')
+    parser.add_argument('-n', '--count', type=int, default=6,
+                        help='Slices in each row [6]')
+    parser.add_argument('-s', '--size', type=int, default=128,
+                        help='Largest side of a slice in pixels [128]')
+    parser.add_argument('-c', '--colormap', default='gray',
+                        choices=sorted(segments),
+                        help='Colormap of the slices [gray]')
+    parser.add_argument('-t', '--timepoint', type=int, default=0,
+                        help='Volume of 4D images [0]')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='NUM',
+                        help='Number of processes rendering images [1]')
+    parser.add_argument('--force', action='store_true',
+                        help='Render images whose PNG is up to date too')
+    args = parser.parse_args()
+
+    skip_dirs = _clean_skip_dirs(args.skip_dirs)
+    paths = sorted(_clean_file_list(args.path))
+    jobs = find_jobs(paths, os.path.abspath(args.output), args.patterns,
+                     skip_dirs, args.exclude, args.force)
+    options = dict(count=args.count, size=args.size, cmap=args.colormap,
+                   tindex=args.timepoint)
+    done, failed = render_all(jobs, options, args.jobs)
+    print 'Rendered %d montages, %d failed' % (done, failed)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,24 @@
+import sys
+import threading
+
+import numpy as np
 
 from enthought.chaco.api import (ArrayPlotData, Plot, gray, GridContainer,
                                  OverlayPlotContainer, GridDataSource, 
-                                 HPlotContainer)
+                                 HPlotContainer, DataRange1D)
 from enthought.enable.component_editor import ComponentEditor
 from enthought.traits.api import (HasTraits, Instance, DelegatesTo, 
                                   on_trait_change, Enum, Array, Int, Str,
-                                  Color, List, Trait, Callable, Dict)
+                                  Color, List, Trait, Callable, Dict, Tuple,
+                                  Any)
 from enthought.traits.ui.api import (Item, View, Menu, MenuBar, Action,
                                      OKButton, CancelButton)
 from enthought.chaco.tools.cursor_tool import CursorTool, BaseCursorTool
 import enthought.chaco.default_colormaps as chaco_colormaps
 from enthought.enable.api import BaseTool
 from enthought.chaco.tools.api import LineInspector
+from enthought.pyface.timer.api import do_later
+from enthought.pyface.api import GUI
 
 
 # File IO imports
@@ -19,16 +26,29 @@ from enthought.traits.api import File, Button
 from enthought.traits.ui.api import HGroup
 from enthought.traits.ui.file_dialog import open_file
 
-from image import Image
-
-def load_image():
-    file_name = File
+from image import Image, slice_axes, fit_level
+from slice_cache import SliceCache
+from image_loader import ImageLoader
+from colormaps import Colorizer, default_size
+from layers import Layer, LayerStack, Blender
+
+def chaco_lut(cmap, size=default_size):
+    """Return the lookup table of size RGBA colors of the chaco
+    colormap function cmap."""
+    mapper = cmap(DataRange1D(low=0.0, high=1.0))
+    colors = np.asarray(mapper.map_screen(np.linspace(0.0, 1.0, size)))
+    return np.round(colors[:, :4] * 255).astype(np.uint8)
+
+def choose_file():
+    """Ask for an image file, return its name or None."""
     file_name = open_file()
     if file_name != '':
-        img = Image(file_name)
-        return img, file_name
+        return file_name
     else:
-        return None, None
+        return None
+
+# The slice that changes with each voxel coordinate
+voxel_slices = {'x': 'sagittal', 'y': 'coronal', 'z': 'axial'}
 
 class Crosshairs(BaseTool):
     event_state = Enum("normal", "mousedown")
@@ -62,10 +82,38 @@ class Crosshairs(BaseTool):
         self.event_state = "normal"
         event.handled = True
 
+class WindowLevel(BaseTool):
+    """Change the window of the slices by dragging with the right
+    button: moving right widens it, moving up raises its center."""
+    plot = Any
+    event_state = Enum("normal", "dragging")
+
+    def normal_right_down(self, event):
+        if self.plot.colorizer.data is None:
+            # Nothing shown yet, while the image is loading
+            return
+        low, high = self.plot.colorizer.current_window()
+        self._start = event.x, event.y, float(low), float(high)
+        self.event_state = 'dragging'
+        event.handled = True
+
+    def dragging_mouse_move(self, event):
+        x, y, low, high = self._start
+        width = (high - low) * np.exp((event.x - x) / 100.0)
+        center = (low + high) / 2 + (event.y - y) * (high - low) / 100.0
+        self.plot.window = (center - width / 2, center + width / 2)
+        event.handled = True
+
+    def dragging_right_up(self, event):
+        self.event_state = 'normal'
+        event.handled = True
+
 class Voxel(HasTraits):
     x = Int
     y = Int
     z = Int
+    # Volume of a 4D image
+    t = Int
 
     #@on_trait_change('x, y, z')
     #def _anytrait_changed(self, name, old, new):
@@ -73,8 +121,8 @@ class Voxel(HasTraits):
         #print self
 
     def __repr__(self):
-        # Voxel(x, y, z)
-        outstr = 'Voxel(%d, %d, %d)' % (self.x, self.y, self.z)
+        # Voxel(x, y, z, t)
+        outstr = 'Voxel(%d, %d, %d, %d)' % (self.x, self.y, self.z, self.t)
         return outstr
 
 class SlicePlot(Plot):
@@ -83,14 +131,30 @@ class SlicePlot(Plot):
     voxel = Instance(Voxel)
     xindex = Int
     yindex = Int
+    # Pyramid level of the image that fits the plot on screen
+    level = Int(0)
+    max_level = Int(0)
+    # Rows and columns of the full resolution slice
+    full_shape = Tuple(Int, Int)
+    # Turns slices into the RGBA images drawn, so chaco does not map
+    # colors on every redraw
+    colorizer = Instance(Colorizer)
+    # (low, high) intensities mapped to the ends of the colormap, None
+    # for the range of each slice
+    window = Any
+    # (layer, data) of the overlays drawn over the current slice
+    overlays = List
+    blender = Instance(Blender)
 
     def __init__(self, data, **kwtraits):
         super(SlicePlot, self).__init__(data, **kwtraits)
         self.voxel = kwtraits.get('voxel') # XXX what to set for default?
+        self.colorizer = Colorizer(chaco_lut(chaco_colormaps.gray))
+        self.blender = Blender()
 
     def set_slice(self, name):
-        self.renderer = self.img_plot(name, hide_grids=False, 
-                                      colormap=chaco_colormaps.gray)[0]
+        # The data is RGBA, so no chaco colormap is used
+        self.renderer = self.img_plot(name, hide_grids=False)[0]
         self.slicename = name
         self.init_cursor()
 
@@ -99,11 +163,12 @@ class SlicePlot(Plot):
         # functionality in Chaco
         self.cursor = CursorTool(self.renderer, drag_button='left', 
                                  color='blue')
-        x, y = self.data.get_data(self.slicename).shape
+        x, y = self.data.get_data(self.slicename).shape[:2]
         self.cursor.current_position = x/2, y/2
         #self.cursor.current_position = self.voxel.x, self.voxel.y
         self.renderer.overlays.append(self.cursor)
         self.renderer.tools.append(Crosshairs(self.renderer))
+        self.renderer.tools.append(WindowLevel(self.renderer, plot=self))
 
 
     @on_trait_change('xindex, yindex')
@@ -122,6 +187,47 @@ class SlicePlot(Plot):
         #print 'voxel:', self.voxel.get('x', 'y', 'z')
         #print 'intensity:', self.data[y,x]
 
+    @on_trait_change('bounds, index_range.updated, value_range.updated')
+    def _update_level(self):
+        # The voxels in view, over the pixels they are drawn on
+        xspan = self.index_range.high - self.index_range.low
+        yspan = self.value_range.high - self.value_range.low
+        width, height = self.bounds
+        self.level = min(fit_level(xspan, width, self.max_level),
+                         fit_level(yspan, height, self.max_level))
+
+    def show_data(self, data, full_shape, overlays=()):
+        """Show the slice data, which may be of a pyramid level, over
+        the voxel coordinates of a full resolution slice of full_shape
+        rows and columns.
+
+        overlays are (layer, data) of layers.Layer slices of the same
+        shape as data, blended over it bottom one first.
+
+        """
+
+        rows, cols = full_shape
+        self.full_shape = full_shape
+        self.overlays = list(overlays)
+        self._draw(self.colorizer(data))
+        self.renderer.index.set_data(np.linspace(0, cols, data.shape[1] + 1),
+                                     np.linspace(0, rows, data.shape[0] + 1))
+
+    def _draw(self, rgba):
+        """Draw the colored slice rgba with the overlays over it."""
+        if self.overlays:
+            name = self.slicename
+            rgba = self.blender(rgba, [(layer.colorizer(name)(data),
+                                        layer.alpha, data, layer.threshold)
+                                       for layer, data in self.overlays])
+        self.data.set_data(self.slicename, rgba)
+
+    def _window_changed(self, new):
+        # Quantize the current slice again, no voxels are read
+        rgba = self.colorizer.set_window(new)
+        if rgba is not None:
+            self._draw(rgba)
+
     def redraw(self):
         """Redraw the plot."""
         self.renderer.request_redraw()
@@ -137,30 +243,30 @@ class SlicePlot(Plot):
 
         """
 
-        clr_range = self.renderer.color_mapper.range
-        try:
-            # Try chaco colormap
-            color_mapper = cmap(clr_range)
-        except TypeError:
-            # If cmap is not callable (like if it's a string)
+        if not callable(cmap):
             try:
                 # Try cmap as a string
                 cmap = chaco_colormaps.color_map_name_dict[cmap]
-                color_mapper = cmap(clr_range)
             except KeyError:
-                # Not a string assume a chaco colormap function
                 msg = "Unable to find colormap '%s'" % cmap
                 raise KeyError(msg)
-        self.renderer.color_mapper = color_mapper
+        # Recolors the quantized slice, without quantizing it again
+        rgba = self.colorizer.set_lut(chaco_lut(cmap, len(self.colorizer.lut)))
+        if rgba is not None:
+            self._draw(rgba)
         self.redraw()
 
 #
 # Menus and actions
 #
 file_open = Action(name = "Open...", action = "load_image")
-menu_file = Menu(file_open, name = "File")
+overlay_open = Action(name = "Add overlay...", action = "add_overlay")
+overlay_clear = Action(name = "Remove overlays", action = "clear_overlays")
+menu_file = Menu(file_open, overlay_open, overlay_clear, name = "File")
 preferences = Action(name = "Preferences", action = "set_preferences")
-menu_viewer = Menu(preferences, name = "Viewer")
+auto_contrast = Action(name = "Auto contrast", action = "auto_contrast")
+projection = Action(name = "Projection...", action = "set_projection")
+menu_viewer = Menu(preferences, auto_contrast, projection, name = "Viewer")
 menubar = MenuBar(menu_viewer, menu_file)
 
 class Preferences(HasTraits):
@@ -200,6 +306,21 @@ class Viewer(HasTraits):
     plotdata = Instance(ArrayPlotData)
     voxel = Instance(Voxel)
     img = Instance(Image)
+    cache = Instance(SliceCache)
+    loader = Instance(ImageLoader)
+    # Images drawn over img
+    layers = Instance(LayerStack)
+    # Window of all slice plots, see SlicePlot.window
+    window = Any
+    # Percentiles auto_contrast puts at the ends of the window
+    auto_percentiles = Tuple(2.0, 98.0)
+    # Projection shown in the fourth plot: through a slab of slices,
+    # or over time of the axial slice
+    projection_kind = Enum('max', 'mean')
+    projection_axis = Enum('axial', 'coronal', 'sagittal', 'time')
+    # Slices of the slab, slab_stop -1 for up to the last slice
+    slab_start = Int(0)
+    slab_stop = Int(-1)
 
     traits_view = View(
             Item('plot', editor=ComponentEditor(), show_label=False), 
@@ -208,9 +329,30 @@ class Viewer(HasTraits):
             title = "Image Plot",
             menubar = menubar)
 
+    projection_view = View(Item('projection_kind', label='Projection'),
+                           Item('projection_axis', label='Along'),
+                           Item('slab_start'),
+                           Item('slab_stop'),
+                           title = "Projection",
+                           buttons = [OKButton],
+                           resizable = True)
+
     def __init__(self):
         super(Viewer, self).__init__()
-        
+        # Slices waiting to be updated, and whether an update is
+        # scheduled
+        self._dirty = set()
+        self._update_pending = False
+        # Pyramid levels being built, by (img, level, tindex)
+        self._building = set()
+        # Number of the latest projection asked for
+        self._projection_request = 0
+        self.voxel = Voxel()
+        # Placeholder slices until an image is loaded
+        empty = np.zeros((1, 1, 4), np.uint8)
+        self.plotdata = ArrayPlotData(axial=empty, coronal=empty,
+                                      sagittal=empty, projection=empty)
+
         self.load_image()
 
         axl_plt = SlicePlot(self.plotdata, voxel=self.voxel)
@@ -228,48 +370,322 @@ class Viewer(HasTraits):
         sag_plt.sync_trait('xindex', self.voxel, alias='y')
         sag_plt.sync_trait('yindex', self.voxel, alias='z')
 
+        # The spare cell shows projections, not tied to the voxel
+        self.projection_plot = SlicePlot(self.plotdata, voxel=self.voxel)
+        self.projection_plot.set_slice('projection')
+        self.projection_plot.sync_trait('window', self)
+
         # Add our plots to the GridContainer
         self.container.add(axl_plt)
         self.container.add(cor_plt)
         self.container.add(sag_plt)
+        self.container.add(self.projection_plot)
+
+        self.plots = {'axial': axl_plt, 'coronal': cor_plt,
+                      'sagittal': sag_plt}
+        for plt in self.plots.values():
+            plt.on_trait_change(self._level_changed, 'level')
+            plt.sync_trait('window', self)
 
         self.plot = self.container
 
-    def update_slices(self):
-        # Update image slices based on selecte voxel coords.
-        axial = self.img.get_axial_slice(self.voxel.z)
-        coronal = self.img.get_coronal_slice(self.voxel.y)
-        sagittal = self.img.get_sagittal_slice(self.voxel.x)
-
-        if self.plotdata is None:
-            # Create array data container
-            self.plotdata = ArrayPlotData(axial=axial, 
-                                          sagittal=sagittal, 
-                                          coronal=coronal)
-        else:
-            self.plotdata.set_data('axial', axial)
-            self.plotdata.set_data('coronal', coronal)
-            self.plotdata.set_data('sagittal', sagittal)
+    def update_slices(self, names=None):
+        """Update the slices in names, all three if names is None, to
+        the selected voxel."""
+        vox = self.voxel
+        indices = {'axial': vox.z, 'coronal': vox.y, 'sagittal': vox.x}
+        if names is None:
+            names = indices.keys()
+            self._dirty.clear()
+        shape = self.img.ras_shape
+        for name in names:
+            level = self._slice_level(name)
+            data = self.cache.get(name, indices[name], vox.t, level)
+            # The overlay slices through the voxel, read together
+            overlays = self.layers.read(name, indices[name], vox.t, level)
+            fixed, rows, cols = slice_axes[name]
+            # Only the plots whose data is set are redrawn
+            self.plots[name].show_data(data, (shape[rows], shape[cols]),
+                                       overlays)
+
+    def _shown_images(self, tindex):
+        """Return (img, tindex) of the image and the visible overlays
+        shown with volume tindex."""
+        shown = [(self.img, tindex)]
+        for layer in self.layers:
+            if layer.visible:
+                shown.append((layer.img, layer.timepoint(tindex)))
+        return shown
+
+    def _slice_level(self, name):
+        """Return the pyramid level to show slice name at.
+
+        Until the level that fits the plot is built, for the image and
+        all overlays, on worker threads, the full resolution slices are
+        shown.
+
+        """
+
+        level = self.plots[name].level
+        if level == 0:
+            return level
+        ready = True
+        for img, tindex in self._shown_images(self.voxel.t):
+            if not img.has_level(level, tindex):
+                self._build_level(img, level, tindex)
+                ready = False
+        return level if ready else 0
+
+    def _in_background(self, func, done, *args):
+        """Call func(*args) on a worker thread, then done(result) on
+        the GUI thread.  Errors are reported on stderr."""
+        def run():
+            try:
+                result = func(*args)
+            except Exception, err:
+                print >> sys.stderr, '%s failed: %s' % (func.__name__, err)
+                return
+            GUI.invoke_later(done, result)
+        thread = threading.Thread(target=run, name=func.__name__)
+        thread.daemon = True
+        thread.start()
+
+    def _build_level(self, img, level, tindex):
+        """Build a pyramid level of img on a worker thread, then update
+        the slices."""
+        key = (img, level, tindex)
+        if key in self._building:
+            return
+        self._building.add(key)
+        def built(data):
+            self._building.discard(key)
+            if self.img is not None and \
+                    img in [shown for shown, t in self._shown_images(0)]:
+                self._dirty.update(voxel_slices.values())
+                self._schedule_update()
+        self._in_background(img.get_level, built, level, tindex)
+
+    def auto_contrast(self, info=None):
+        """Set the window to the auto_percentiles of the intensities of
+        the current volume.
+
+        The intensity table is computed on a worker thread the first
+        time, after which the window is set without reading voxels.
+
+        """
+
+        if self.img is None:
+            return
+        img = self.img
+        def computed(table):
+            if img is self.img:
+                self.window = table.window(*self.auto_percentiles)
+        self._in_background(img.intensity_table, computed, self.voxel.t)
+
+    def set_projection(self, info=None):
+        self.edit_traits(view='projection_view', kind='live')
+
+    @on_trait_change('projection_kind, projection_axis, slab_start, '
+                     'slab_stop')
+    def update_projection(self):
+        """Compute the projection on a worker thread and show it.
+
+        Projections through slabs are built from blocks cached in the
+        Image, so changing the slab only reads the planes at its ends.
+
+        """
 
-    @on_trait_change('voxel.[x,y,z]')
+        if self.img is None:
+            return
+        img = self.img
+        kind = self.projection_kind
+        axis = self.projection_axis
+        zindex, tindex = self.voxel.z, self.voxel.t
+        start = self.slab_start
+        stop = self.slab_stop if self.slab_stop >= 0 else None
+        self._projection_request += 1
+        request = self._projection_request
+        def project():
+            if axis == 'time':
+                return img.volume_slice(img.time_projection(kind), 'axial',
+                                        zindex)
+            return img.projection(axis, kind, start, stop, tindex)
+        def done(proj):
+            # Drop projections that were asked for before the latest
+            if img is self.img and request == self._projection_request:
+                self.projection_plot.show_data(proj, proj.shape)
+        self._in_background(project, done)
+
+    def _level_changed(self, plot, name, old, new):
+        # The plot was resized or zoomed to another level
+        self._dirty.add(plot.slicename)
+        self._schedule_update()
+
+    @on_trait_change('voxel.[x,y,z,t]')
     def _voxel_changed(self, name, old, new):
         #print '_voxel_changed, name:', name, 'old:', old, 'new:', new
-        self.update_slices()
+        if name in voxel_slices:
+            self._dirty.add(voxel_slices[name])
+        else:
+            # A new timepoint, or a new voxel
+            self._dirty.update(voxel_slices.values())
+        self._schedule_update()
+        if name in voxel_slices or name == 't':
+            self.prefetch(name, new - old)
+        # Slab projections are of the current volume, time projections
+        # of the current axial slice
+        axis = self.projection_axis
+        if name == 't' and axis != 'time' or name == 'z' and axis == 'time':
+            self.update_projection()
+
+    def _schedule_update(self):
+        """Update the dirty slices once pending events are handled."""
+        if not self._update_pending:
+            # Moves that come in before the update runs are handled by
+            # the same update.
+            self._update_pending = True
+            do_later(self._update_dirty)
+
+    def _update_dirty(self):
+        """Update the slices changed since the last update."""
+        self._update_pending = False
+        names = list(self._dirty)
+        self._dirty.clear()
+        if names and self.cache is not None:
+            self.update_slices(names)
+
+    def prefetch(self, name, step):
+        """Read ahead the slices the cursor is moving towards, after
+        voxel coordinate name moved by step."""
+        if self.cache is None or step == 0:
+            return
+        step = 1 if step > 0 else -1
+        vox = self.voxel
+        current = {'sagittal': vox.x, 'coronal': vox.y, 'axial': vox.z}
+        if name == 't':
+            keys = []
+            for slicename, index in current.iteritems():
+                level = self._slice_level(slicename)
+                keys.extend(self.cache.ahead(slicename, index, vox.t, step,
+                                             time=True, level=level))
+        else:
+            slicename = voxel_slices[name]
+            level = self._slice_level(slicename)
+            keys = self.cache.ahead(slicename, current[slicename], vox.t,
+                                    step, level=level)
+        self.cache.prefetch(keys)
+        self.layers.prefetch(keys)
 
     def load_image(self, info=None):
         # Load image
-        img, filename = load_image()
-        if img is not None:
-            self.img = img
-            self.filename = filename
-            xdim, ydim, zdim = self.img.shape
-            if self.voxel is None:
-                self.voxel = Voxel(x=xdim/2, y=ydim/2, z=zdim/2)
-            else:
-                self.voxel.x = xdim/2
-                self.voxel.y = ydim/2
-                self.voxel.z = zdim/2
+        filename = choose_file()
+        if filename is not None:
+            self.open_image(filename)
+
+    def open_image(self, filename):
+        """Start loading the image filename in the background.
+
+        A preview of its center slices is shown first if the image is
+        large, then the full slices.  An image still loading is
+        cancelled.
+
+        """
+
+        if self.loader is not None:
+            self.loader.cancel()
+        if self.cache is not None:
+            self.cache.close()
+        if self.layers is not None:
+            self.layers.clear()
+        # Slices are not updated until the new image is ready
+        self.cache = None
+        self.layers = None
+        self.img = None
+        self.window = None
+        self.loader = ImageLoader(filename, self._load_progress)
+        self.loader.start()
+
+    def _load_progress(self, loader, stage, value):
+        # Called on the loader thread, hand over to the GUI thread
+        GUI.invoke_later(self._load_stage, loader, stage, value)
+
+    def _load_stage(self, loader, stage, value):
+        """Show the stage of loading reported by loader."""
+        if loader is not self.loader:
+            # Cancelled by a newer load
+            return
+        if stage == 'preview':
+            img, slices = value
+            self._center_voxel(img)
+            for name, data in slices.iteritems():
+                self.plots[name].show_data(data, data.shape)
+        elif stage == 'ready':
+            self.loader = None
+            self.cache = value
+            self.img = value.img
+            self.layers = LayerStack(self.img)
+            self.filename = loader.filename
+            for plt in self.plots.values():
+                plt.max_level = self.img.max_level
+                plt._update_level()
+            self._center_voxel(self.img)
             self.update_slices()
+            self.update_projection()
+            self.auto_contrast()
+        elif stage == 'error':
+            self.loader = None
+            print >> sys.stderr, 'Unable to load %s: %s' % (loader.filename,
+                                                           value)
+
+    def add_overlay(self, info=None):
+        if self.img is None:
+            return
+        filename = choose_file()
+        if filename is not None:
+            self.open_overlay(filename)
+
+    def open_overlay(self, filename, cmap='hot', alpha=0.5, threshold=None):
+        """Load the image filename on a worker thread and draw it over
+        the slices, see layers.Layer for the parameters.
+
+        It must be on the grid of the image shown.  Its window is set
+        to the auto_percentiles of its intensities.
+
+        """
+
+        if self.img is None:
+            return
+        layers = self.layers
+        percentiles = self.auto_percentiles
+        def load_overlay():
+            img = Image(filename)
+            layers.check(img)
+            window = img.intensity_table().window(*percentiles)
+            return Layer(img, cmap, alpha, window, threshold)
+        def loaded(layer):
+            if layers is not self.layers:
+                # Another image was opened meanwhile
+                layer.close()
+                return
+            layers.add(layer)
+            self._dirty.update(voxel_slices.values())
+            self._schedule_update()
+        self._in_background(load_overlay, loaded)
+
+    def clear_overlays(self, info=None):
+        if self.layers is None or not len(self.layers):
+            return
+        self.layers.clear()
+        self._dirty.update(voxel_slices.values())
+        self._schedule_update()
+
+    def _center_voxel(self, img):
+        """Select the center voxel of the first volume of img."""
+        xdim, ydim, zdim = img.ras_shape
+        self.voxel.x = xdim/2
+        self.voxel.y = ydim/2
+        self.voxel.z = zdim/2
+        self.voxel.t = 0
 
     def set_preferences(self, info=None):
         # XXX Separate Handler from view and attach actions to the
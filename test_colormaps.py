@@ -0,0 +1,47 @@
+"""Tests of colormaps.py.
+
+Run with:
+    $ python -m unittest test_colormaps
+
+"""
+
+import unittest
+
+import numpy as np
+
+from colormaps import Colorizer, get_lut
+
+class TestColorizer(unittest.TestCase):
+
+    def test_nan_slice(self):
+        data = np.array([[np.nan, 0.0, 1.0], [2.0, 3.0, 4.0]], np.float32)
+        colorizer = Colorizer(get_lut('gray'))
+        rgba = colorizer(data)
+        self.assertEqual(colorizer.current_window(), (0.0, 4.0))
+        # The finite values span the whole table
+        self.assertEqual(rgba[0, 1, 0], 0)
+        self.assertEqual(rgba[1, 2, 0], 255)
+        self.assertTrue((np.diff(rgba[1, :, 0].astype(int)) > 0).all())
+
+    def test_infinite_values(self):
+        data = np.array([-np.inf, 1.0, 3.0, np.inf])
+        colorizer = Colorizer(get_lut('gray'))
+        colorizer(data)
+        self.assertEqual(colorizer.current_window(), (1.0, 3.0))
+
+    def test_no_finite_values(self):
+        data = np.empty((2, 2))
+        data.fill(np.nan)
+        colorizer = Colorizer(get_lut('gray'))
+        colorizer(data)
+        self.assertEqual(colorizer.current_window(), (0, 1))
+
+    def test_integer_slice(self):
+        data = np.arange(6, dtype=np.int16).reshape(2, 3)
+        colorizer = Colorizer(get_lut('gray'))
+        rgba = colorizer(data)
+        self.assertEqual(colorizer.current_window(), (0, 5))
+        self.assertEqual(rgba[1, 2, 0], 255)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Tests of file_stats.py.
+
+Run with:
+    $ python -m unittest test_file_stats
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import file_stats
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def crc_collision(data, nbytes=8):
+    """Return data with some of its first nbytes changed so it has the
+    same crc32 as data.
+
+    For messages of one length crc32 is linear over GF(2) up to a
+    constant, so changing the bits of a nonzero solution of
+    crc(data ^ d) == crc(data) keeps the crc.  One is found by
+    Gaussian elimination on the crc of each bit flipped alone.
+
+    """
+
+    base = _crc(data)
+    # (crc change, bit flips) for each single bit flipped
+    rows = []
+    for bit in range(nbytes * 8):
+        flipped = bytearray(data)
+        flipped[bit // 8] ^= 1 << (bit % 8)
+        rows.append((_crc(str(flipped)) ^ base, 1 << bit))
+    # Reduce until a combination of flips changes nothing
+    pivots = {}
+    for change, flips in rows:
+        while change:
+            top = change.bit_length() - 1
+            if top not in pivots:
+                pivots[top] = (change, flips)
+                break
+            pchange, pflips = pivots[top]
+            change ^= pchange
+            flips ^= pflips
+        else:
+            forged = bytearray(data)
+            for bit in range(nbytes * 8):
+                if flips >> bit & 1:
+                    forged[bit // 8] ^= 1 << (bit % 8)
+            return str(forged)
+    raise ValueError('No collision in the first %d bytes' % nbytes)
+
+class TestDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix='test_file_stats')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, name, data):
+        filename = os.path.join(self.dirname, name)
+        fp = open(filename, 'wb')
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
+        return filename
+
+    def test_crc_collision_not_duplicate(self):
+        data = os.urandom(1000)
+        forged = crc_collision(data)
+        self.assertNotEqual(data, forged)
+        self.assertEqual(_crc(data), _crc(forged))
+        files = [self._write('a.nii', data), self._write('b.nii', forged)]
+        table = file_stats.file_sizes(files)
+        hashed = file_stats.duplicate_hashes(table, partial_algo='crc32')
+        self.assertEqual(file_stats.duplicate_groups(hashed), [])
+
+    def test_identical_files(self):
+        data = os.urandom(1000)
+        files = [self._write('a.nii', data), self._write('b.nii', data)]
+        table = file_stats.file_sizes(files)
+        hashed = file_stats.duplicate_hashes(table, partial_algo='crc32')
+        groups = file_stats.duplicate_groups(hashed)
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(sorted(groups[0][0]), sorted(files))
+
+    def test_crc_final_digest_refused(self):
+        table = file_stats.file_sizes([])
+        self.assertRaises(ValueError, file_stats.duplicate_hashes, table,
+                          algo='crc32')
+        self.assertTrue('crc32' not in file_stats.digest_algorithms)
+        self.assertTrue('crc32' in file_stats.hash_algorithms)
+
+if __name__ == '__main__':
+    unittest.main()